@@ -0,0 +1,10 @@
+"""Офлайн-бенчмарк: заглушки OpenAI/Unsplash и нагрузочный драйвер
+
+Запуск из папки backend:
+
+    python -m bench.run --concurrency 1,8,32 --duration 10 --out bench.json
+    python -m bench.run --compare bench.json      # сравнить с прошлой сборкой
+
+Реальные ключи и сеть не нужны: сервис поднимается отдельным процессом
+и ходит в локальные заглушки (bench/stubs.py).
+"""
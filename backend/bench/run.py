@@ -0,0 +1,341 @@
+"""Нагрузочный драйвер: поднимает заглушки и сервис, гоняет сценарии, пишет JSON
+
+Каждый сценарий (generate, styles, health) прогоняется на каждом уровне
+конкурентности замкнутым циклом: N воркеров шлют следующий запрос сразу
+после ответа на предыдущий. В отчёте — пропускная способность, p50/p95/p99
+и распределение статусов; --compare сравнивает с отчётом прошлой сборки.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("generate", "styles", "health")
+PROXY_VARS = ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "http_proxy", "https_proxy", "all_proxy")
+
+
+def percentile(sorted_values: List[float], share: float) -> float:
+    """Перцентиль по ближайшему рангу; sorted_values уже отсортирован"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(share * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def clean_env(**overrides: str) -> Dict[str, str]:
+    env = {key: value for key, value in os.environ.items() if key not in PROXY_VARS}
+    env.update(overrides)
+    return env
+
+
+def ensure_port_free(port: int):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        if sock.connect_ex(("127.0.0.1", port)) == 0:
+            raise RuntimeError(f"Порт {port} уже занят: остановите старый процесс или задайте другой порт")
+
+
+def spawn(args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], cwd=BACKEND_DIR, env=env)
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(trust_env=False) as client:
+        while True:
+            try:
+                response = await client.get(url, timeout=1.0)
+                if response.status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} не ответил за {timeout:.0f} с")
+            await asyncio.sleep(0.2)
+
+
+class Workload:
+    """Строит запросы сценария generate: доля демо-режима и повторов промптов"""
+
+    def __init__(self, styles: List[str], demo_ratio: float, repeat_ratio: float, seed: int):
+        self.styles = styles or ["creative"]
+        self.demo_ratio = demo_ratio
+        self.repeat_ratio = repeat_ratio
+        self.rng = random.Random(seed)
+        self.counter = itertools.count()
+        self.sent: List[str] = []
+
+    def generate_payload(self) -> dict:
+        if self.sent and self.rng.random() < self.repeat_ratio:
+            text = self.rng.choice(self.sent)
+        else:
+            text = f"bench prompt {next(self.counter)} {self.rng.getrandbits(32):08x}"
+            self.sent.append(text)
+        payload = {"text": text, "style": self.rng.choice(self.styles), "unsplash_key": "bench-unsplash"}
+        if self.rng.random() >= self.demo_ratio:
+            payload["api_key"] = "sk-bench"
+        return payload
+
+
+async def run_level(client: httpx.AsyncClient, scenario: str, concurrency: int,
+                    duration: float, max_requests: int, workload: Workload) -> dict:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    modes: Counter = Counter()
+    issued = itertools.count()
+    started = time.perf_counter()
+    deadline = started + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            if max_requests and next(issued) >= max_requests:
+                return
+            request_started = time.perf_counter()
+            try:
+                if scenario == "generate":
+                    response = await client.post("/generate", json=workload.generate_payload())
+                else:
+                    response = await client.get(f"/{scenario}")
+                status = str(response.status_code)
+                if scenario == "generate" and response.status_code == 200:
+                    modes[response.json().get("mode", "unknown")] += 1
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - request_started)
+            statuses[status] += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(latencies) - ok,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0
+        },
+        "statuses": dict(statuses)
+    }
+    if modes:
+        result["modes"] = dict(modes)
+    return result
+
+
+def compare(current: List[dict], baseline: List[dict]) -> List[dict]:
+    """Относительные изменения throughput и p95 для совпадающих (сценарий, конкурентность)"""
+    previous = {(item["scenario"], item["concurrency"]): item for item in baseline}
+    rows = []
+    for item in current:
+        before = previous.get((item["scenario"], item["concurrency"]))
+        if before is None:
+            continue
+
+        def delta(now: float, then: float) -> Optional[float]:
+            return round((now - then) / then, 4) if then else None
+
+        rows.append({
+            "scenario": item["scenario"],
+            "concurrency": item["concurrency"],
+            "throughput_change": delta(item["throughput_rps"], before["throughput_rps"]),
+            "p95_change": delta(item["latency_ms"]["p95"], before["latency_ms"]["p95"]),
+            "p99_change": delta(item["latency_ms"]["p99"], before["latency_ms"]["p99"])
+        })
+    return rows
+
+
+def regressed(rows: List[dict], threshold: float) -> List[dict]:
+    return [
+        row for row in rows
+        if (row["throughput_change"] is not None and row["throughput_change"] < -threshold)
+        or (row["p95_change"] is not None and row["p95_change"] > threshold)
+    ]
+
+
+def print_header():
+    print(f"{'scenario':<10} {'conc':>5} {'reqs':>7} {'err':>5} {'rps':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=sys.stderr)
+
+
+def print_summary(results: List[dict]):
+    for item in results:
+        latency = item["latency_ms"]
+        print(f"{item['scenario']:<10} {item['concurrency']:>5} {item['requests']:>7} {item['errors']:>5} "
+              f"{item['throughput_rps']:>9.1f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} "
+              f"{latency['p99']:>9.1f}", file=sys.stderr)
+
+
+async def run(args) -> dict:
+    processes: List[subprocess.Popen] = []
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    app_url = args.app_url
+    try:
+        if not args.no_stubs:
+            ensure_port_free(args.stub_port)
+            processes.append(spawn(["-m", "bench.stubs"], clean_env(
+                STUB_PORT=str(args.stub_port),
+                STUB_OPENAI_LATENCY=args.openai_latency,
+                STUB_OPENAI_ERRORS=args.openai_errors,
+                STUB_UNSPLASH_LATENCY=args.unsplash_latency,
+                STUB_UNSPLASH_ERRORS=args.unsplash_errors,
+                STUB_SEED=str(args.seed)
+            )))
+            await wait_ready(f"{stub_url}/stub/stats")
+        if app_url is None:
+            app_url = f"http://127.0.0.1:{args.app_port}"
+            ensure_port_free(args.app_port)
+            # Всё состояние сервиса — во временной папке, а не в исходниках backend/
+            state_dir = tempfile.mkdtemp(prefix="illustraitor-bench-")
+            processes.append(spawn(
+                ["-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                 "--port", str(args.app_port), "--log-level", "warning", "--no-access-log"],
+                clean_env(
+                    OPENAI_BASE_URL=f"{stub_url}/v1",
+                    UNSPLASH_API_URL=stub_url,
+                    # Лимит апстрима меряем отдельно; здесь он только исказил бы цифры
+                    OPENAI_IMAGES_PER_MINUTE="1000000",
+                    IMAGE_STORE_DIR=os.path.join(state_dir, "image_store"),
+                    DB_PATH=os.path.join(state_dir, "illustraitor.db"),
+                    LEDGER_JOURNAL_DIR=os.path.join(state_dir, "ledger"),
+                    DERIVATIVE_DIR=os.path.join(state_dir, "image_variants"),
+                    # Фоновое перекодирование делило бы CPU с измеряемыми запросами
+                    DERIVATIVE_EAGER="",
+                    LOG_LEVEL="WARNING"
+                )
+            ))
+        await wait_ready(f"{app_url}/health")
+
+        limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=args.timeout, trust_env=False) as client:
+            styles = [style["id"] for style in (await client.get("/styles")).json().get("styles", [])]
+            workload = Workload(styles, args.demo_ratio, args.repeat_ratio, args.seed)
+            results = []
+            print_header()
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    if args.warmup:
+                        await run_level(client, scenario, concurrency, args.warmup, 0, workload)
+                    result = await run_level(client, scenario, concurrency, args.duration, args.requests, workload)
+                    results.append(result)
+                    print_summary([result])
+
+        stub_stats = None
+        if not args.no_stubs:
+            async with httpx.AsyncClient(trust_env=False) as client:
+                stub_stats = (await client.get(f"{stub_url}/stub/stats")).json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {
+                "duration_s": args.duration,
+                "max_requests": args.requests,
+                "warmup_s": args.warmup,
+                "demo_ratio": args.demo_ratio,
+                "repeat_ratio": args.repeat_ratio,
+                "openai_latency": args.openai_latency,
+                "openai_errors": args.openai_errors,
+                "unsplash_latency": args.unsplash_latency,
+                "unsplash_errors": args.unsplash_errors,
+                "seed": args.seed
+            }
+        },
+        "results": results,
+        "stubs": stub_stats
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Illustraitor AI")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [item for item in value.split(",") if item in SCENARIOS])
+    parser.add_argument("--concurrency", default="1,8,32",
+                        type=lambda value: [int(item) for item in value.split(",")])
+    parser.add_argument("--duration", type=float, default=10.0, help="секунд на каждый уровень")
+    parser.add_argument("--requests", type=int, default=0, help="максимум запросов на уровень (0 — без лимита)")
+    parser.add_argument("--warmup", type=float, default=1.0, help="секунд прогрева перед замером")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--demo-ratio", type=float, default=0.2, help="доля generate без OpenAI-ключа")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="доля повторных промптов (кэш)")
+    parser.add_argument("--openai-latency", default="lognormal:1.5,0.35")
+    parser.add_argument("--openai-errors", default="429=0.01,500=0.01")
+    parser.add_argument("--unsplash-latency", default="uniform:0.03,0.12")
+    parser.add_argument("--unsplash-errors", default="500=0.005")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--stub-port", type=int, default=8765)
+    parser.add_argument("--app-port", type=int, default=8799)
+    parser.add_argument("--app-url", help="уже запущенный сервис вместо локального процесса")
+    parser.add_argument("--no-stubs", action="store_true", help="не поднимать заглушки")
+    parser.add_argument("--out", help="куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON-отчёт прошлой сборки для сравнения")
+    parser.add_argument("--fail-on-regression", type=float, default=None,
+                        help="код выхода 1, если throughput упал или p95 вырос больше чем на эту долю")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        report["comparison"] = {
+            "baseline_revision": baseline.get("meta", {}).get("git_revision"),
+            "rows": compare(report["results"], baseline.get("results", []))
+        }
+        if args.fail_on_regression is not None and regressed(report["comparison"]["rows"], args.fail_on_regression):
+            exit_code = 1
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""Заглушки OpenAI Images и Unsplash с настраиваемой задержкой и ошибками
+
+Поведение задаётся переменными окружения, чтобы драйвер мог поднять
+заглушки отдельным процессом:
+
+    STUB_OPENAI_LATENCY=lognormal:1.5,0.35    # медиана 1.5 с
+    STUB_OPENAI_ERRORS=429=0.02,500=0.01      # доля ответов с ошибкой
+    STUB_UNSPLASH_LATENCY=uniform:0.03,0.12
+    STUB_UNSPLASH_ERRORS=500=0
+    STUB_SEED=42
+
+Распределения задержки: fixed:S, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA.
+"""
+import asyncio
+import base64
+import math
+import os
+import random
+import time
+from collections import Counter
+from typing import Callable, Dict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+# PNG 1x1, чтобы хранилище изображений видело настоящий формат
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+def parse_latency(spec: str, rng: random.Random) -> Callable[[], float]:
+    """"lognormal:1.5,0.35" -> функция, возвращающая задержку в секундах"""
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value.strip()]
+    kind = kind.strip().lower()
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        low, high = values
+        return lambda: rng.uniform(low, high)
+    if kind == "lognormal":
+        median, sigma = values
+        mu = math.log(median)
+        return lambda: rng.lognormvariate(mu, sigma)
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def parse_errors(spec: str) -> Dict[int, float]:
+    """"429=0.02,500=0.01" -> {429: 0.02, 500: 0.01}"""
+    errors = {}
+    for part in spec.split(","):
+        status, _, share = part.partition("=")
+        if status.strip() and share.strip():
+            errors[int(status)] = float(share)
+    return errors
+
+
+class Upstream:
+    """Задержка, выбор ошибки и счётчики ответов одного апстрима"""
+
+    def __init__(self, latency: str, errors: str, rng: random.Random):
+        self.latency = parse_latency(latency, rng)
+        self.errors = parse_errors(errors)
+        self.rng = rng
+        self.responses: Counter = Counter()
+
+    async def delay(self):
+        await asyncio.sleep(max(self.latency(), 0.0))
+
+    def pick_error(self) -> int:
+        """Статус ошибки или 0, если отвечаем успешно"""
+        roll = self.rng.random()
+        for status, share in self.errors.items():
+            if roll < share:
+                return status
+            roll -= share
+        return 0
+
+
+rng = random.Random(int(os.environ.get("STUB_SEED", "42")))
+openai_upstream = Upstream(
+    os.environ.get("STUB_OPENAI_LATENCY", "lognormal:1.5,0.35"),
+    os.environ.get("STUB_OPENAI_ERRORS", ""),
+    rng
+)
+unsplash_upstream = Upstream(
+    os.environ.get("STUB_UNSPLASH_LATENCY", "uniform:0.03,0.12"),
+    os.environ.get("STUB_UNSPLASH_ERRORS", ""),
+    rng
+)
+generated = 0
+
+app = FastAPI(title="Illustraitor bench stubs")
+
+
+def openai_error(status: int) -> JSONResponse:
+    if status == 429:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after-ms": "500"}
+        )
+    return JSONResponse(
+        {"error": {"message": "Stub upstream error", "type": "server_error", "code": None}},
+        status_code=status
+    )
+
+
+@app.post("/v1/images/generations")
+async def images_generations(request: Request):
+    global generated
+    body = await request.json()
+    await openai_upstream.delay()
+    status = openai_upstream.pick_error()
+    openai_upstream.responses[status or 200] += 1
+    if status:
+        return openai_error(status)
+
+    generated += 1
+    if body.get("response_format") == "b64_json":
+        # Уникальные байты, иначе хранилище сведёт все картинки к одной
+        data = base64.b64encode(PNG + str(generated).encode()).decode()
+        item = {"b64_json": data, "revised_prompt": body.get("prompt", "")[:200]}
+    else:
+        item = {"url": f"{request.base_url}img/{generated}.png", "revised_prompt": body.get("prompt", "")[:200]}
+    return {"created": int(time.time()), "data": [item]}
+
+
+@app.get("/img/{name}")
+async def image(name: str):
+    return Response(PNG, media_type="image/png")
+
+
+@app.get("/search/photos")
+async def search_photos(query: str, per_page: int = 1):
+    await unsplash_upstream.delay()
+    status = unsplash_upstream.pick_error()
+    unsplash_upstream.responses[status or 200] += 1
+    if status:
+        return JSONResponse({"errors": ["Stub upstream error"]}, status_code=status)
+    return {
+        "total": per_page,
+        "results": [
+            {"urls": {"regular": f"https://images.unsplash.com/photo-stub-{abs(hash(query)) % 10000}-{i}"}}
+            for i in range(per_page)
+        ]
+    }
+
+
+@app.get("/stub/stats")
+async def stub_stats():
+    return {
+        "openai": {str(status): count for status, count in openai_upstream.responses.items()},
+        "unsplash": {str(status): count for status, count in unsplash_upstream.responses.items()}
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("STUB_PORT", 8765))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
@@ -0,0 +1,105 @@
+"""In-memory кэши с LRU-вытеснением и TTL"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUTTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей
+
+    При sliding=True TTL отсчитывается от последнего обращения (idle TTL),
+    иначе от момента записи. on_evict(key, value) вызывается для каждой
+    вытесненной или истёкшей записи.
+    """
+
+    def __init__(self, max_size: int, ttl: float, sliding: bool = False,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_evict = on_evict
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, list]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > self._clock()
+
+    def _drop(self, key: Hashable, expired: bool):
+        value, _ = self._data.pop(key)
+        if expired:
+            self.expirations += 1
+        else:
+            self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        now = self._clock()
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[1] <= now:
+            self._drop(key, expired=True)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        if self.sliding:
+            entry[1] = now + self.ttl
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        if key in self._data:
+            self._data.pop(key)
+        now = self._clock()
+        self._data[key] = [value, now + (self.ttl if ttl is None else ttl)]
+        # Самые старые по обращению записи чаще всего и истекли первыми:
+        # чистим голову очереди, не обходя весь словарь
+        while self._data:
+            oldest = next(iter(self._data))
+            if self._data[oldest][1] > now:
+                break
+            self._drop(oldest, expired=True)
+        while len(self._data) > self.max_size:
+            self._drop(next(iter(self._data)), expired=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def purge_expired(self) -> int:
+        """Удаляет истёкшие записи и возвращает их количество"""
+        now = self._clock()
+        expired = [key for key, (_, expires) in self._data.items() if expires <= now]
+        for key in expired:
+            self._drop(key, expired=True)
+        return len(expired)
+
+    def clear(self):
+        for key in list(self._data):
+            self._drop(key, expired=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
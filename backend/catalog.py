@@ -0,0 +1,38 @@
+"""Заранее сериализованные ответы для редко меняющихся эндпоинтов"""
+import hashlib
+
+import orjson
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+class PrecomputedResponse:
+    """Готовые байты ответа с ETag; If-None-Match отвечает 304 без тела"""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+    @classmethod
+    def json(cls, content, cache_control: str) -> "PrecomputedResponse":
+        return cls(orjson.dumps(content), "application/json", cache_control)
+
+    @classmethod
+    def html(cls, content: str, cache_control: str) -> "PrecomputedResponse":
+        return cls(content.encode("utf-8"), "text/html", cache_control)
+
+    def matches(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # Слабое сравнение: W/"x" совпадает с "x" (так делают прокси со сжатием)
+        return "*" in tags or any(tag.removeprefix("W/") == self.etag for tag in tags)
+
+    def respond(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control}
+        if self.matches(request):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type=self.media_type, headers=headers)
@@ -0,0 +1,91 @@
+"""Кэш готовых клиентов OpenAI по хэшу API ключа"""
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+
+from cache import LRUTTLCache
+from timing import span
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Стабильный идентификатор ключа, который можно хранить и логировать"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class _Lease:
+    __slots__ = ("client", "in_use", "retired")
+
+    def __init__(self, client: Any):
+        self.client = client
+        self.in_use = 0
+        self.retired = False
+
+
+class ClientCache:
+    """LRU + idle TTL кэш клиентов, чтобы повторно использовать их пулы соединений
+
+    Вытесненный клиент закрывается сразу, если им никто не пользуется,
+    иначе после завершения последнего запроса.
+    """
+
+    def __init__(self, factory: Callable[[str], Any], max_size: int, idle_ttl: float):
+        self.factory = factory
+        self._cache = LRUTTLCache(max_size=max_size, ttl=idle_ttl, sliding=True,
+                                  on_evict=self._on_evict)
+        self.created = 0
+        self.closed = 0
+        self._closing = set()
+
+    def _on_evict(self, key: str, lease: _Lease):
+        lease.retired = True
+        if lease.in_use == 0:
+            self._close(lease)
+
+    def _close(self, lease: _Lease):
+        self.closed += 1
+        try:
+            task = asyncio.get_running_loop().create_task(lease.client.close())
+        except RuntimeError:
+            # Вне event loop закрыть асинхронный клиент нечем: соединения
+            # освободит сборщик мусора
+            return
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @asynccontextmanager
+    async def lease(self, api_key: str):
+        """Выдаёт клиента для ключа на время одного запроса"""
+        key = key_fingerprint(api_key)
+        lease = self._cache.get(key)
+        if lease is None:
+            # Промах — хороший момент заодно закрыть простаивающих клиентов
+            self._cache.purge_expired()
+            with span("client"):
+                lease = _Lease(self.factory(api_key))
+            self.created += 1
+            self._cache.set(key, lease)
+        lease.in_use += 1
+        try:
+            yield lease.client
+        finally:
+            lease.in_use -= 1
+            if lease.retired and lease.in_use == 0:
+                self._close(lease)
+
+    def sweep(self) -> int:
+        """Закрывает клиентов, простоявших дольше idle TTL"""
+        return self._cache.purge_expired()
+
+    async def close_all(self):
+        self._cache.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats.update({"created": self.created, "closed": self.closed})
+        return stats
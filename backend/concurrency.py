@@ -0,0 +1,30 @@
+"""Ограничение параллелизма по ключу (например, по API ключу пользователя)"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List
+
+
+class KeyedSemaphore:
+    """Отдельный семафор на каждый ключ; неиспользуемые семафоры удаляются"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        # ключ -> [семафор, число владельцев и ожидающих]
+        self._slots: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = [asyncio.Semaphore(self.limit), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0 and self._slots.get(key) is slot:
+                del self._slots[key]
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active_keys": len(self._slots)}
@@ -0,0 +1,188 @@
+"""Настройки сервера из переменных окружения"""
+import os
+
+
+def env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# ========== ЛОГИРОВАНИЕ ==========
+
+LOG_LEVEL = env_str("LOG_LEVEL", "INFO")
+# json — одна запись на строку с полями (request_id и др.), text — прежний формат
+LOG_FORMAT = env_str("LOG_FORMAT", "json")
+# Доля пошаговых записей, которые попадают в лог, по уровням
+LOG_SAMPLE_RATES = env_str("LOG_SAMPLE_RATES", "INFO=0.2,DEBUG=0.05")
+
+# ========== OPENAI ==========
+
+# Сколько генераций DALL-E одновременно держит один воркер
+OPENAI_MAX_CONCURRENCY = env_int("OPENAI_MAX_CONCURRENCY", 32)
+# Сколько секунд запрос может ждать свободный слот, прежде чем уйти в демо
+OPENAI_QUEUE_TIMEOUT = env_float("OPENAI_QUEUE_TIMEOUT", 10.0)
+# Таймаут одного запроса к images API
+OPENAI_REQUEST_TIMEOUT = env_float("OPENAI_REQUEST_TIMEOUT", 60.0)
+# Кэш готовых клиентов по хэшу ключа: размер и время простоя до закрытия (сек)
+OPENAI_CLIENT_CACHE_SIZE = env_int("OPENAI_CLIENT_CACHE_SIZE", 256)
+OPENAI_CLIENT_IDLE_TTL = env_float("OPENAI_CLIENT_IDLE_TTL", 600.0)
+# Лимит изображений в минуту на один ключ (уточняется по заголовкам OpenAI)
+# и сколько секунд запрос может ждать своей очереди вместо перехода в демо
+OPENAI_IMAGES_PER_MINUTE = env_float("OPENAI_IMAGES_PER_MINUTE", 15.0)
+OPENAI_RATE_WAIT_BUDGET = env_float("OPENAI_RATE_WAIT_BUDGET", 20.0)
+
+# Circuit breaker: сколько транзиентных ошибок подряд открывают цепь
+# и через сколько секунд пробовать снова
+OPENAI_BREAKER_FAILURES = env_int("OPENAI_BREAKER_FAILURES", 5)
+OPENAI_BREAKER_RECOVERY = env_float("OPENAI_BREAKER_RECOVERY", 30.0)
+OPENAI_BREAKER_HALF_OPEN_CALLS = env_int("OPENAI_BREAKER_HALF_OPEN_CALLS", 1)
+# Повторы транзиентных ошибок (сеть, таймауты, 5xx) с jittered backoff
+OPENAI_RETRY_ATTEMPTS = env_int("OPENAI_RETRY_ATTEMPTS", 3)
+OPENAI_RETRY_BASE_DELAY = env_float("OPENAI_RETRY_BASE_DELAY", 0.5)
+OPENAI_RETRY_MAX_DELAY = env_float("OPENAI_RETRY_MAX_DELAY", 4.0)
+
+# Кэш результатов генерации. TTL меньше часа: ссылки DALL-E живут около часа
+RESULT_CACHE_ENABLED = env_bool("RESULT_CACHE_ENABLED", True)
+RESULT_CACHE_MAX_SIZE = env_int("RESULT_CACHE_MAX_SIZE", 1000)
+RESULT_CACHE_TTL = env_float("RESULT_CACHE_TTL", 3000.0)
+
+# ========== ОБЩЕЕ СОСТОЯНИЕ ==========
+
+# Где хранить кэши, dedup и счётчики лимитов: memory (один процесс),
+# sqlite:///state.db (воркеры на одной машине) или redis://host:6379/0
+STATE_BACKEND = env_str("STATE_BACKEND", "memory")
+STATE_KEY_PREFIX = env_str("STATE_KEY_PREFIX", "illustraitor:")
+# Объединение одинаковых запросов между процессами: аренда ключа,
+# сколько опубликованный результат ждёт опрашивающих (не меньше двух интервалов
+# опроса; это не кэш — повторы после вызова его не получают) и как часто его проверять
+DEDUP_LEASE_TTL = env_float("DEDUP_LEASE_TTL", 120.0)
+DEDUP_RESULT_TTL = env_float("DEDUP_RESULT_TTL", 0.5)
+DEDUP_POLL_INTERVAL = env_float("DEDUP_POLL_INTERVAL", 0.25)
+
+# ========== МАРШРУТИЗАЦИЯ ПРОВАЙДЕРОВ ==========
+
+# OpenAI-совместимый бэкенд (провайдер openai_compat); пустой URL — не подключать.
+# Нужен собственный серверный ключ: OpenAI-ключ пользователя на сторонний хост не уходит
+OPENAI_COMPAT_BASE_URL = env_str("OPENAI_COMPAT_BASE_URL", "")
+OPENAI_COMPAT_API_KEY = env_str("OPENAI_COMPAT_API_KEY", "")
+OPENAI_COMPAT_MODEL = env_str("OPENAI_COMPAT_MODEL", "dall-e-3")
+OPENAI_COMPAT_IMAGES_PER_MINUTE = env_float("OPENAI_COMPAT_IMAGES_PER_MINUTE", 60.0)
+
+# Политики: группы через ";" пробуются по порядку, провайдеры внутри группы
+# (через ",") ранжируются по EWMA задержки с поправкой на долю ошибок.
+# Тариф pro — запрос с OpenAI-ключом, free — без него. С OPENAI_COMPAT_BASE_URL
+# провайдер openai_compat добавляется в политику явно: "openai,openai_compat;unsplash;static"
+ROUTING_POLICY_PRO = env_str("ROUTING_POLICY_PRO", "openai;unsplash;static")
+ROUTING_POLICY_FREE = env_str("ROUTING_POLICY_FREE", "unsplash;static")
+# Переопределения по стилю: "anime=openai_compat,openai;static|vintage@free=static"
+ROUTING_STYLE_POLICIES = env_str("ROUTING_STYLE_POLICIES", "")
+ROUTING_EWMA_ALPHA = env_float("ROUTING_EWMA_ALPHA", 0.2)
+ROUTING_ERROR_PENALTY = env_float("ROUTING_ERROR_PENALTY", 4.0)
+# Доля запросов со случайным порядком внутри группы, чтобы оценки не устаревали
+ROUTING_EXPLORE_RATE = env_float("ROUTING_EXPLORE_RATE", 0.05)
+
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+
+JOB_WORKERS = env_int("JOB_WORKERS", 16)
+JOB_MAX_QUEUE = env_int("JOB_MAX_QUEUE", 500)
+# Сколько секунд хранить результат завершённой задачи
+JOB_RESULT_TTL = env_float("JOB_RESULT_TTL", 3600.0)
+JOB_SSE_HEARTBEAT = env_float("JOB_SSE_HEARTBEAT", 15.0)
+
+# Пакетная генерация: максимум текстов в пакете и параллельных генераций на ключ
+BATCH_MAX_ITEMS = env_int("BATCH_MAX_ITEMS", 50)
+BATCH_PER_KEY_CONCURRENCY = env_int("BATCH_PER_KEY_CONCURRENCY", 5)
+
+# ========== ПОХОЖИЕ ПРОМПТЫ ==========
+
+# Индекс MinHash/LSH прошлых промптов по стилям (строится из истории generations)
+SIMILARITY_ENABLED = env_bool("SIMILARITY_ENABLED", False)
+# Минимальное сходство по Жаккару (0..1), при котором промпты считаются одинаковыми
+SIMILARITY_THRESHOLD = env_float("SIMILARITY_THRESHOLD", 0.8)
+SIMILARITY_MAX_ENTRIES = env_int("SIMILARITY_MAX_ENTRIES", 10000)
+# true — сразу вернуть найденное изображение, false — сгенерировать и только предложить его
+SIMILARITY_REUSE = env_bool("SIMILARITY_REUSE", True)
+
+# ========== БАЗА ДАННЫХ ==========
+
+# Пользователи, кредиты и история генераций
+DB_PATH = env_str("DB_PATH", "illustraitor.db")
+DB_POOL_SIZE = env_int("DB_POOL_SIZE", 4)
+DB_BUSY_TIMEOUT = env_float("DB_BUSY_TIMEOUT", 5.0)
+# Кредиты нового пользователя после /register
+NEW_USER_CREDITS = env_int("NEW_USER_CREDITS", 10)
+# История пишется пачками: до N записей или раз в интервал, очередь ограничена
+GENERATION_LOG_BATCH = env_int("GENERATION_LOG_BATCH", 100)
+GENERATION_LOG_FLUSH_INTERVAL = env_float("GENERATION_LOG_FLUSH_INTERVAL", 0.5)
+GENERATION_LOG_MAX_QUEUE = env_int("GENERATION_LOG_MAX_QUEUE", 10000)
+# Размер страницы GET /history по умолчанию и максимальный
+HISTORY_PAGE_SIZE = env_int("HISTORY_PAGE_SIZE", 20)
+HISTORY_MAX_PAGE_SIZE = env_int("HISTORY_MAX_PAGE_SIZE", 100)
+# Журнал списаний кредитов до переноса в базу и период переноса
+LEDGER_JOURNAL_DIR = env_str("LEDGER_JOURNAL_DIR", "ledger")
+LEDGER_FLUSH_INTERVAL = env_float("LEDGER_FLUSH_INTERVAL", 1.0)
+# fsync каждой записи журнала: переживает отключение питания, но медленнее
+LEDGER_JOURNAL_FSYNC = env_bool("LEDGER_JOURNAL_FSYNC", False)
+
+# ========== ХРАНИЛИЩЕ ИЗОБРАЖЕНИЙ ==========
+
+# Сохранять сгенерированные изображения локально и отдавать через /images/{digest}
+IMAGE_STORE_ENABLED = env_bool("IMAGE_STORE_ENABLED", True)
+IMAGE_STORE_DIR = env_str("IMAGE_STORE_DIR", "image_store")
+# Внешний адрес сервиса для абсолютных ссылок; по умолчанию берётся из запроса
+PUBLIC_BASE_URL = env_str("PUBLIC_BASE_URL", "")
+# Миниатюры и WebP/AVIF-варианты сохранённых изображений (нужен Pillow)
+DERIVATIVES_ENABLED = env_bool("DERIVATIVES_ENABLED", True)
+DERIVATIVE_DIR = env_str("DERIVATIVE_DIR", "image_variants")
+# Процессы перекодирования и варианты, которые строятся сразу после генерации
+DERIVATIVE_WORKERS = env_int("DERIVATIVE_WORKERS", 2)
+DERIVATIVE_EAGER = env_str("DERIVATIVE_EAGER", "preview")
+
+# ========== HTTP ПУЛ И UNSPLASH ==========
+
+UNSPLASH_API_URL = env_str("UNSPLASH_API_URL", "https://api.unsplash.com")
+# Размер общего пула соединений к внешним HTTP API
+HTTP_POOL_MAX_CONNECTIONS = env_int("HTTP_POOL_MAX_CONNECTIONS", 100)
+HTTP_POOL_MAX_KEEPALIVE = env_int("HTTP_POOL_MAX_KEEPALIVE", 20)
+HTTP_POOL_KEEPALIVE_EXPIRY = env_float("HTTP_POOL_KEEPALIVE_EXPIRY", 60.0)
+HTTP_CONNECT_TIMEOUT = env_float("HTTP_CONNECT_TIMEOUT", 3.0)
+HTTP_TIMEOUT = env_float("HTTP_TIMEOUT", 30.0)
+UNSPLASH_TIMEOUT = env_float("UNSPLASH_TIMEOUT", 5.0)
+# Кэш поиска Unsplash: сколько кандидатов брать за один запрос и сколько их хранить
+UNSPLASH_PER_PAGE = env_int("UNSPLASH_PER_PAGE", 10)
+UNSPLASH_CACHE_MAX_SIZE = env_int("UNSPLASH_CACHE_MAX_SIZE", 2000)
+UNSPLASH_CACHE_TTL = env_float("UNSPLASH_CACHE_TTL", 3600.0)
+UNSPLASH_NEGATIVE_TTL = env_float("UNSPLASH_NEGATIVE_TTL", 300.0)
+
+# ========== ДИАГНОСТИКА ==========
+
+# Токен для /admin/*; пустой — админ-эндпоинты выключены
+ADMIN_TOKEN = env_str("ADMIN_TOKEN", "")
+PROFILE_DIR = env_str("PROFILE_DIR", "profiles")
+
+# ========== СТАРТ ==========
+
+# Откладывать импорт клиентов OpenAI/httpx и сборку каталога до первого использования
+FAST_START = env_bool("FAST_START", True)
+# В режиме FAST_START догружать отложенное в фоне сразу после старта
+STARTUP_WARMUP = env_bool("STARTUP_WARMUP", True)
@@ -0,0 +1,494 @@
+"""Пользователи, кредиты и история генераций в SQLite
+
+Соединения открываются один раз и переиспользуются из пула, база работает
+в режиме WAL (читатели не ждут писателя), а записи истории копятся
+в очереди и пишутся пачками в одной транзакции.
+"""
+import asyncio
+import base64
+import binascii
+import logging
+import queue
+import re
+import secrets
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS users ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " email TEXT UNIQUE,"
+    " name TEXT,"
+    " api_key TEXT UNIQUE,"
+    " credits INTEGER DEFAULT 10,"
+    " created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS generations ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " user_id INTEGER,"
+    " text TEXT,"
+    " style TEXT,"
+    " image_url TEXT,"
+    " credits_used INTEGER,"
+    " created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,"
+    " size TEXT,"
+    " quality TEXT,"
+    " FOREIGN KEY (user_id) REFERENCES users (id))",
+    # История пользователя читается по user_id в порядке времени (id в индексе неявно)
+    "CREATE INDEX IF NOT EXISTS idx_generations_user_created ON generations (user_id, created_at)",
+    # До какого номера записи журнал кредитов процесса уже перенесён в users
+    "CREATE TABLE IF NOT EXISTS ledger_checkpoints ("
+    " journal TEXT PRIMARY KEY,"
+    " seq INTEGER NOT NULL)",
+)
+
+# Колонки, добавленные после первого выпуска схемы: (таблица, колонка, тип)
+ADDED_COLUMNS = (
+    ("generations", "size", "TEXT"),
+    ("generations", "quality", "TEXT"),
+)
+
+# Полнотекстовый индекс промптов поверх generations; триггеры держат его в актуальном состоянии
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts"
+    " USING fts5(text, content='generations', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN"
+    " INSERT INTO generations_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN"
+    " INSERT INTO generations_fts (generations_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF text ON generations BEGIN"
+    " INSERT INTO generations_fts (generations_fts, rowid, text) VALUES ('delete', old.id, old.text);"
+    " INSERT INTO generations_fts (rowid, text) VALUES (new.id, new.text); END",
+)
+
+HISTORY_COLUMNS = "g.id, g.text, g.style, g.image_url, g.credits_used, g.created_at"
+
+# Тексты запросов — константы: sqlite3 кэширует подготовленные выражения по тексту SQL
+SQL_USER_BY_KEY = "SELECT id, email, name, credits FROM users WHERE api_key = ?"
+SQL_INSERT_USER = "INSERT INTO users (email, name, api_key, credits) VALUES (?, ?, ?, ?)"
+# Оплаченные генерации с изображением — материал для индекса похожих промптов
+SQL_RECENT_GENERATIONS = (
+    "SELECT style, size, quality, text, image_url FROM generations"
+    " WHERE credits_used > 0 AND image_url IS NOT NULL AND size IS NOT NULL"
+    " ORDER BY id DESC LIMIT ?"
+)
+SQL_CHARGE_CREDITS = "UPDATE users SET credits = credits - ? WHERE id = ?"
+SQL_LEDGER_SEQ = "SELECT seq FROM ledger_checkpoints WHERE journal = ?"
+SQL_LEDGER_CHECKPOINT = (
+    "INSERT INTO ledger_checkpoints (journal, seq) VALUES (?, ?)"
+    " ON CONFLICT(journal) DO UPDATE SET seq = excluded.seq"
+)
+SQL_LEDGER_FORGET = "DELETE FROM ledger_checkpoints WHERE journal = ?"
+SQL_INSERT_GENERATION = (
+    "INSERT INTO generations (user_id, text, style, size, quality, image_url, credits_used, created_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class User(NamedTuple):
+    id: int
+    email: str
+    name: str
+    credits: int
+
+
+class HistoryItem(NamedTuple):
+    id: int
+    text: str
+    style: str
+    image_url: Optional[str]
+    credits_used: int
+    created_at: str
+
+
+class EmailTakenError(Exception):
+    """Пользователь с таким email уже зарегистрирован"""
+
+
+def new_user_key() -> str:
+    return f"ilust_{secrets.token_hex(16)}"
+
+
+def fts_query(text: str) -> Optional[str]:
+    """Поисковая строка пользователя -> запрос FTS5: все слова, последнее — как префикс
+
+    Слова берутся в кавычки, поэтому синтаксис FTS5 (NEAR, OR, "*") из ввода не исполняется.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def encode_cursor(item: HistoryItem) -> str:
+    """Непрозрачный курсор страницы: ключ (created_at, id) последней строки"""
+    return base64.urlsafe_b64encode(f"{item.created_at}|{item.id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Обратное к encode_cursor(); ValueError для чужой или испорченной строки"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, _, row_id = raw.rpartition("|")
+        return created_at, int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Неверный курсор") from None
+
+
+def db_timestamp(moment: Optional[datetime] = None) -> str:
+    """Время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+    return (moment or datetime.utcnow()).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ConnectionPool:
+    """Не больше size соединений; занятые ждут освобождения
+
+    Соединения создаются по мере надобности и живут до close_all().
+    Последнее возвращённое выдаётся первым: у него тёплый кэш страниц.
+    """
+
+    def __init__(self, path: str, size: int, busy_timeout: float, statement_cache: int = 128):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.statement_cache = statement_cache
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.waits = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,  # транзакции открываются явно
+            check_same_thread=False,
+            cached_statements=self.statement_cache
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+        self.waits += 1
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            # Соединение вернулось посреди транзакции (ошибка) — не отдаём его дальше грязным
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "open": self._created,
+            "idle": self._idle.qsize(),
+            "waits": self.waits
+        }
+
+
+class Database:
+    """Асинхронный доступ к базе: каждый вызов — поток из пула и соединение из ConnectionPool
+
+    Конструктор файл базы не трогает: схема создаётся в start() при запуске сервиса.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4, busy_timeout: float = 5.0):
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size, busy_timeout)
+        self.queries = 0
+        self.errors = 0
+        self.fts = False
+
+    async def start(self):
+        await asyncio.to_thread(self._migrate)
+
+    def _migrate(self):
+        conn = self.pool.acquire()
+        try:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            for table, column, column_type in ADDED_COLUMNS:
+                existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            self._migrate_fts(conn)
+        finally:
+            self.pool.release(conn)
+
+    def _migrate_fts(self, conn: sqlite3.Connection):
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generations_fts'"
+        ).fetchone()
+        try:
+            for statement in FTS_SCHEMA:
+                conn.execute(statement)
+        except sqlite3.OperationalError as e:
+            # SQLite собран без FTS5 — поиск по истории пойдёт через LIKE
+            logger.warning("FTS5 недоступен, поиск по истории без индекса: %s", e)
+            return
+        if not exists:
+            # Индекс создан поверх уже накопленной истории — заполняем его один раз
+            conn.execute("INSERT INTO generations_fts (generations_fts) VALUES ('rebuild')")
+        self.fts = True
+
+    def _call(self, fn: Callable, *args):
+        conn = self.pool.acquire()
+        try:
+            return fn(conn, *args)
+        finally:
+            self.pool.release(conn)
+
+    async def run(self, fn: Callable, *args):
+        """fn(conn, *args) в отдельном потоке с соединением из пула"""
+        self.queries += 1
+        try:
+            return await asyncio.to_thread(self._call, fn, *args)
+        except sqlite3.IntegrityError:
+            raise
+        except sqlite3.Error:
+            self.errors += 1
+            raise
+
+    @staticmethod
+    def transaction(conn: sqlite3.Connection, fn: Callable, *args):
+        """Выполняет fn(conn, *args) в одной транзакции с блокировкой записи"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def get_user(self, api_key: str) -> Optional[User]:
+        row = await self.run(lambda conn: conn.execute(SQL_USER_BY_KEY, (api_key,)).fetchone())
+        return User(*row) if row else None
+
+    async def create_user(self, email: str, name: str, credits: int) -> Tuple[User, str]:
+        """Новый пользователь и его ключ сервиса"""
+        api_key = new_user_key()
+
+        def insert(conn: sqlite3.Connection) -> int:
+            return conn.execute(SQL_INSERT_USER, (email, name, api_key, credits)).lastrowid
+
+        try:
+            user_id = await self.run(insert)
+        except sqlite3.IntegrityError:
+            raise EmailTakenError(email) from None
+        return User(user_id, email, name, credits), api_key
+
+    @staticmethod
+    def _charge(conn: sqlite3.Connection, journal: str, deltas: Dict[int, int], seq: int):
+        conn.executemany(SQL_CHARGE_CREDITS, [(amount, user_id) for user_id, amount in deltas.items()])
+        conn.execute(SQL_LEDGER_CHECKPOINT, (journal, seq))
+
+    async def charge_credits(self, journal: str, deltas: Dict[int, int], seq: int):
+        """Списывает накопленные суммы и отмечает, что журнал перенесён по запись seq
+
+        Всё в одной транзакции: при повторе после сбоя записи до seq не спишутся дважды.
+        """
+        await self.run(self.transaction, self._charge, journal, deltas, seq)
+
+    async def replay_credit_journal(self, journal: str, entries: Iterable[Tuple[int, int, int]]) -> int:
+        """Переносит записи (seq, user_id, amount) журнала упавшего процесса; возвращает число новых"""
+        def replay(conn: sqlite3.Connection) -> int:
+            row = conn.execute(SQL_LEDGER_SEQ, (journal,)).fetchone()
+            done = row[0] if row else 0
+            deltas: Dict[int, int] = {}
+            applied, last = 0, done
+            for seq, user_id, amount in entries:
+                if seq > done:
+                    deltas[user_id] = deltas.get(user_id, 0) + amount
+                    applied, last = applied + 1, max(last, seq)
+            if deltas:
+                self._charge(conn, journal, deltas, last)
+            return applied
+        return await self.run(self.transaction, replay)
+
+    async def history(self, user_id: int, limit: int, before: Optional[Tuple[str, int]] = None,
+                      query: Optional[str] = None,
+                      styles: Optional[List[str]] = None) -> List[HistoryItem]:
+        """Страница истории от новых к старым, начиная строго после ключа before
+
+        Keyset-пагинация по (created_at, id): каждая страница — спуск по индексу,
+        а не пропуск OFFSET строк, поэтому её цена не растёт с глубиной.
+        """
+        where = ["g.user_id = ?"]
+        params: list = [user_id]
+        source = "generations g"
+        if query:
+            if self.fts:
+                match = fts_query(query)
+                if match is None:
+                    return []
+                source = "generations_fts f JOIN generations g ON g.id = f.rowid"
+                where.append("generations_fts MATCH ?")
+                params.append(match)
+            else:
+                # % и _ из запроса — обычные символы, а не шаблоны LIKE
+                escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                where.append("g.text LIKE ? ESCAPE '\\'")
+                params.append(f"%{escaped}%")
+        if styles:
+            where.append(f"g.style IN ({', '.join('?' * len(styles))})")
+            params.extend(styles)
+        if before is not None:
+            where.append("(g.created_at, g.id) < (?, ?)")
+            params.extend(before)
+        sql = (
+            f"SELECT {HISTORY_COLUMNS} FROM {source} WHERE {' AND '.join(where)}"
+            " ORDER BY g.created_at DESC, g.id DESC LIMIT ?"
+        )
+        params.append(limit)
+        rows = await self.run(lambda conn: conn.execute(sql, params).fetchall())
+        return [HistoryItem(*row) for row in rows]
+
+    async def recent_generations(self, limit: int) -> List[Tuple[str, str, str, str, str]]:
+        """(style, size, quality, text, image_url) последних AI-генераций, от новых к старым"""
+        return await self.run(lambda conn: conn.execute(SQL_RECENT_GENERATIONS, (limit,)).fetchall())
+
+    async def forget_journal(self, journal: str):
+        await self.run(lambda conn: conn.execute(SQL_LEDGER_FORGET, (journal,)))
+
+    async def insert_generations(self, rows: List[tuple]):
+        await self.run(self.transaction, lambda conn: conn.executemany(SQL_INSERT_GENERATION, rows))
+
+    def close(self):
+        self.pool.close_all()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "queries": self.queries,
+            "errors": self.errors,
+            "fts": self.fts,
+            "pool": self.pool.stats()
+        }
+
+
+class GenerationLog:
+    """Отложенная запись истории генераций
+
+    add() не ждёт базу: запись встаёт в очередь, фоновая задача забирает
+    до batch_size записей (или всё, что накопилось за flush_interval)
+    и пишет их одной транзакцией. При переполнении очереди записи
+    отбрасываются — история не должна тормозить генерацию.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 100, flush_interval: float = 0.5,
+                 max_queue: int = 10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._writer())
+
+    def add(self, user_id: int, text: str, style: str, size: str, quality: str,
+            image_url: Optional[str], credits_used: int):
+        if self._queue is None:
+            self.dropped += 1
+            return
+        row = (user_id, text, style, size, quality, image_url, credits_used, db_timestamp())
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Очередь истории генераций переполнена, запись отброшена")
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        row = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[tuple]):
+        try:
+            await self.db.insert_generations(batch)
+        except sqlite3.Error as e:
+            self.failed += len(batch)
+            logger.error("Не удалось записать %d генераций в историю: %s", len(batch), e)
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    async def stop(self):
+        """Дописывает накопленное и останавливает запись"""
+        if self._task is None:
+            return
+        # Маркер конца встаёт в очередь после всех уже принятых записей
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
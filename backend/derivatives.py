@@ -0,0 +1,193 @@
+"""Производные изображений (миниатюры, WebP/AVIF) в пуле процессов с кэшем на диске
+
+Перекодирование занимает CPU на сотни миллисекунд, поэтому идёт в отдельных
+процессах, а не в потоках цикла событий. Готовый вариант лежит файлом рядом
+с остальными и отдаётся так же, как оригинал. Pillow — необязательная
+зависимость: без неё варианты просто недоступны.
+"""
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, NamedTuple, Optional, Set
+
+from image_store import ImageStore
+from startup import lazy_import
+
+logger = logging.getLogger(__name__)
+
+
+class Variant(NamedTuple):
+    max_side: Optional[int]  # None — исходный размер
+    format: str
+    extension: str
+    quality: int
+
+
+VARIANTS: Dict[str, Variant] = {
+    "thumb": Variant(256, "WEBP", "webp", 75),
+    # Для попапа расширения (350 px) с запасом под экраны высокой плотности
+    "preview": Variant(640, "WEBP", "webp", 80),
+    "webp": Variant(None, "WEBP", "webp", 85),
+    "avif": Variant(None, "AVIF", "avif", 60),
+}
+
+
+def render_variant(source: str, target: str, max_side: Optional[int], image_format: str,
+                   quality: int) -> int:
+    """Выполняется в дочернем процессе: пишет вариант атомарно и возвращает его размер"""
+    from PIL import Image
+
+    with Image.open(source) as image:
+        if max_side is not None:
+            # reducing_gap: грубое уменьшение до ресэмплинга, заметно быстрее на 1024+ px
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        directory = os.path.dirname(target)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format=image_format, quality=quality)
+            os.replace(tmp_path, target)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    return os.path.getsize(target)
+
+
+class DerivativeStore:
+    """Варианты изображений из ImageStore: <root>/<вариант>/<2 символа>/<sha256>.<ext>
+
+    Вариант строится при первом запросе (одновременные запросы ждут одну
+    сборку), а варианты из eager — сразу после сохранения нового изображения.
+    """
+
+    def __init__(self, store: ImageStore, root: str, workers: int = 2,
+                 eager: Iterable[str] = ()):
+        self.store = store
+        self.root = os.path.abspath(root)
+        self.workers = workers
+        self.eager = [name for name in eager if name in VARIANTS]
+        self.available = importlib.util.find_spec("PIL") is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._building: Dict[str, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # Варианты в форматах, которые установленный Pillow записать не умеет (например, AVIF)
+        self.unsupported: Set[str] = set()
+        self._formats_checked = False
+        self.hits = 0
+        self.rendered = 0
+        self.rendered_bytes = 0
+        self.errors = 0
+
+    def path(self, digest: str, variant: str) -> str:
+        return os.path.join(self.root, variant, digest[:2], f"{digest}.{VARIANTS[variant].extension}")
+
+    def _check_formats(self):
+        """Один раз сверяет форматы вариантов со сборкой Pillow; PIL грузится при первом обращении"""
+        self._formats_checked = True
+        features = lazy_import("PIL.features")
+        for name, spec in VARIANTS.items():
+            if not features.check(spec.format.lower()):
+                self.unsupported.add(name)
+                logger.warning("Pillow собран без %s: вариант %s недоступен", spec.format, name)
+
+    def supports(self, variant: str) -> bool:
+        if not self.available or variant not in VARIANTS:
+            return False
+        if not self._formats_checked:
+            self._check_formats()
+        return variant not in self.unsupported
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: форк процесса с потоками (логирование, пулы) небезопасен.
+            # Дочерний процесс импортирует этот модуль ради render_variant и заново
+            # выполняет __main__ родителя: под uvicorn — только его точку входа, при
+            # запуске `python main.py` — весь main.py без блока `if __name__ == "__main__"`
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def get(self, digest: str, variant: str) -> Optional[str]:
+        """Путь к готовому варианту; None — нет исходника или вариант не поддерживается"""
+        if not self.supports(variant):
+            return None
+        path = self.path(digest, variant)
+        if os.path.isfile(path):
+            self.hits += 1
+            return path
+        if not self.store.exists(digest):
+            return None
+
+        key = f"{variant}/{digest}"
+        building = self._building.get(key)
+        if building is None:
+            building = asyncio.ensure_future(self._render(digest, variant, path))
+            self._building[key] = building
+            building.add_done_callback(lambda _: self._building.pop(key, None))
+        return await asyncio.shield(building)
+
+    async def _render(self, digest: str, variant: str, path: str) -> Optional[str]:
+        spec = VARIANTS[variant]
+        loop = asyncio.get_running_loop()
+        try:
+            size = await loop.run_in_executor(
+                self._executor(), render_variant,
+                self.store.path(digest), path, spec.max_side, spec.format, spec.quality
+            )
+        except BrokenProcessPool:
+            # Дочерний процесс умер (OOM и т.п.) — следующий запрос создаст пул заново
+            self._pool = None
+            self.errors += 1
+            logger.error("Пул обработки изображений сломан, вариант %s не построен", variant)
+            return None
+        except Exception as e:
+            self.errors += 1
+            if isinstance(e, KeyError) or (isinstance(e, OSError) and "encoder" in str(e)):
+                # Формат не поддерживается сборкой Pillow — больше не пытаемся
+                self.unsupported.add(variant)
+                logger.warning("Вариант %s недоступен: %s", variant, e)
+            else:
+                logger.error("Вариант %s для %s не построен: %s", variant, digest[:12], e)
+            return None
+        self.rendered += 1
+        self.rendered_bytes += size
+        return path
+
+    def schedule(self, digest: str):
+        """Построить eager-варианты нового изображения в фоне"""
+        for variant in self.eager:
+            if self.supports(variant):
+                task = asyncio.ensure_future(self.get(digest, variant))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "available": self.available,
+            "workers": self.workers,
+            "building": len(self._building),
+            "hits": self.hits,
+            "rendered": self.rendered,
+            "rendered_bytes": self.rendered_bytes,
+            "errors": self.errors
+        }
@@ -0,0 +1,190 @@
+"""Асинхронный движок генерации изображений через OpenAI"""
+import asyncio
+import base64
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+from client_cache import ClientCache, key_fingerprint
+from rate_limit import UpstreamRateLimiter, retry_after_seconds
+from resilience import CircuitBreaker, RetryPolicy, is_transient
+from metrics import UPSTREAM_LATENCY
+from timing import span
+from startup import lazy_import, lazy_import_async
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+class EngineBusyError(Exception):
+    """Все слоты генерации заняты дольше допустимого времени ожидания"""
+
+
+class GeneratedImage(NamedTuple):
+    url: Optional[str]
+    data: Optional[bytes]
+    revised_prompt: Optional[str]
+
+
+class ImageEngine:
+    """Генерация через AsyncOpenAI с ограничением числа одновременных запросов
+
+    base_url позволяет направить движок на любой OpenAI-совместимый бэкенд;
+    name — метка апстрима в метриках.
+    """
+
+    def __init__(self, max_concurrency: int, queue_timeout: float, request_timeout: float,
+                 client_cache_size: int = 256, client_idle_ttl: float = 600.0,
+                 limiter: Optional[UpstreamRateLimiter] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 retry: Optional[RetryPolicy] = None,
+                 name: str = "openai", base_url: Optional[str] = None,
+                 model: str = "dall-e-3", style: Optional[str] = "vivid"):
+        self.name = name
+        self.base_url = base_url or None
+        self.model = model
+        self.style = style
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retry = retry
+        self.clients = ClientCache(
+            factory=self._create_client,
+            max_size=client_cache_size,
+            idle_ttl=client_idle_ttl
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def _acquire(self):
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise EngineBusyError(
+                f"Нет свободных слотов генерации за {self.queue_timeout} с"
+            ) from None
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _create_client(self, api_key: str) -> "AsyncOpenAI":
+        # Повторы на 429 делает сам движок с учётом лимитера, а не SDK вслепую
+        openai = lazy_import("openai")
+        return openai.AsyncOpenAI(api_key=api_key, base_url=self.base_url,
+                                  timeout=self.request_timeout, max_retries=0)
+
+    async def generate(self, api_key: str, prompt: str, size: str, quality: str,
+                       style: Optional[str] = None,
+                       response_format: str = "url") -> GeneratedImage:
+        """Генерирует одно изображение моделью движка (по умолчанию DALL-E 3)
+
+        С response_format="b64_json" байты приходят в том же ответе,
+        и отдельное скачивание по временной ссылке не нужно.
+        """
+        # SDK грузится при первой генерации (или прогревом), а не при старте
+        RateLimitError = (await lazy_import_async("openai")).RateLimitError
+        key = key_fingerprint(api_key)
+        # style есть только у DALL-E 3; совместимые бэкенды его могут не принять
+        style = style or self.style
+        extra = {"style": style} if style else {}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.limiter.wait_budget if self.limiter else 0.0)
+        attempt = 0
+        while True:
+            # Открытая цепь отклоняет вызов сразу, до очередей и сети
+            if self.breaker is not None:
+                self.breaker.before_call()
+            attempt += 1
+            try:
+                with span("openai_queue"):
+                    if self.limiter is not None:
+                        await self.limiter.acquire(key, max_wait=deadline - loop.time())
+                    await self._acquire()
+                started = time.perf_counter()
+                outcome = "error"
+                try:
+                    async with self.clients.lease(api_key) as client:
+                        with span("openai"):
+                            raw = await client.images.with_raw_response.generate(
+                                model=self.model,
+                                prompt=prompt[:4000],
+                                size=size,
+                                quality=quality,
+                                n=1,
+                                response_format=response_format,
+                                **extra
+                            )
+                    outcome = "success"
+                except RateLimitError:
+                    outcome = "rate_limited"
+                    raise
+                finally:
+                    UPSTREAM_LATENCY.labels(self.name, outcome).observe(time.perf_counter() - started)
+                    self._release()
+            except RateLimitError as e:
+                # 429 — апстрим жив, просто просит подождать
+                self._record_outcome(None)
+                # insufficient_quota — это исчерпанный баланс, ожидание не поможет
+                if self.limiter is None or e.code == "insufficient_quota":
+                    raise
+                headers = e.response.headers
+                await self.limiter.observe_headers(key, headers)
+                delay = retry_after_seconds(headers) or 60.0 / self.limiter.per_minute
+                await self.limiter.penalize(key, delay)
+                if loop.time() + delay > deadline:
+                    raise
+                continue
+            except Exception as e:
+                self._record_outcome(e)
+                if self.retry is None or not self.retry.should_retry(e, attempt):
+                    raise
+                self.retry.retries += 1
+                await asyncio.sleep(self.retry.backoff(attempt))
+                continue
+            except BaseException:
+                if self.breaker is not None:
+                    self.breaker.record_cancelled()
+                raise
+            self._record_outcome(None)
+            if self.limiter is not None:
+                await self.limiter.observe_headers(key, raw.headers)
+            image = raw.parse().data[0]
+            return GeneratedImage(
+                url=image.url,
+                data=base64.b64decode(image.b64_json) if image.b64_json else None,
+                revised_prompt=image.revised_prompt
+            )
+
+    def _record_outcome(self, error: Optional[BaseException]):
+        """Для breaker провалом считаются только транзиентные ошибки апстрима"""
+        if self.breaker is None:
+            return
+        if error is not None and is_transient(error):
+            self.breaker.record_failure()
+        elif error is None or getattr(error, "status_code", None) is not None:
+            self.breaker.record_success()
+        else:
+            # Локальные ошибки (очередь, лимитер) ничего не говорят об апстриме
+            self.breaker.record_cancelled()
+
+    async def close(self):
+        await self.clients.close_all()
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "clients": self.clients.stats(),
+            "rate_limit": self.limiter.stats() if self.limiter else None,
+            "circuit": self.breaker.stats() if self.breaker else None,
+            "retries": self.retry.retries if self.retry else 0
+        }
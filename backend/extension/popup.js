@@ -137,7 +137,7 @@ function initApp() {
                 console.log("🖼️ URL изображения:", data.image_url);
                 // Создаём изображение
                 const img = document.createElement('img');
-                img.src = data.image_url;
+                img.src = (data.variants && data.variants.preview) || data.image_url;
                 img.alt = "AI иллюстрация";
                 img.style.maxWidth = "100%";
                 img.style.borderRadius = "8px";
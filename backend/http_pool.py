@@ -0,0 +1,48 @@
+"""Общий keep-alive пул HTTP-соединений к внешним API"""
+from typing import TYPE_CHECKING, Optional
+
+from startup import lazy_import
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class HttpPool:
+    """Один httpx.AsyncClient на всё время жизни приложения
+
+    httpx импортируется при создании клиента, а не при импорте модуля.
+    """
+
+    def __init__(self, max_connections: int, max_keepalive: int,
+                 keepalive_expiry: float, connect_timeout: float, timeout: float):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._client: Optional["httpx.AsyncClient"] = None
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        # Ленивое создание на случай вызова до события startup
+        if self._client is None or self._client.is_closed:
+            httpx = lazy_import("httpx")
+            # Прокси из окружения игнорируем так же, как generate() для OpenAI
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=self.keepalive_expiry
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                trust_env=False
+            )
+        return self._client
+
+    async def start(self):
+        _ = self.client
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
@@ -0,0 +1,209 @@
+"""Контентно-адресуемое хранилище изображений на диске и их раздача"""
+import hashlib
+import os
+import re
+import stat
+import tempfile
+from typing import Optional, Tuple
+
+import anyio
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Изображения по дайджесту никогда не меняются
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def sniff_media_type(head: bytes) -> str:
+    for magic, media_type in _MAGIC:
+        if head.startswith(magic):
+            return media_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+
+if hasattr(os, "pread"):
+    def read_at(file, length: int, offset: int) -> bytes:
+        return os.pread(file.fileno(), length, offset)
+else:  # Windows: pread нет; файл у каждого ответа свой, поэтому seek не гоняется с другими чтениями
+    def read_at(file, length: int, offset: int) -> bytes:
+        file.seek(offset)
+        return file.read(length)
+
+
+class ImageStore:
+    """Байты изображений в файлах <root>/<2 символа>/<sha256>"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return bool(DIGEST_RE.match(digest)) and os.path.isfile(self.path(digest))
+
+    def put_sync(self, data: bytes) -> str:
+        """Сохраняет байты и возвращает их sha256; повторная запись не нужна"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Пишем во временный файл рядом и атомарно переименовываем,
+        # чтобы читатели никогда не видели недописанный файл
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return digest
+
+    async def put(self, data: bytes) -> str:
+        return await anyio.to_thread.run_sync(self.put_sync, data)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Разбирает одиночный диапазон bytes=...; возвращает (start, end) включительно
+
+    None — заголовок не поддерживается и нужно отдать файл целиком.
+    Для невыполнимого диапазона бросает ValueError.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            end = min(end, size - 1)
+    except ValueError:
+        raise ValueError("invalid range") from None
+    if start < 0 or start > end or start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+class ImageFileResponse(Response):
+    """Отдача файла из хранилища с ETag, Range и zero-copy отправкой
+
+    Если ASGI-сервер поддерживает расширение http.response.zerocopysend,
+    файл уходит в сокет через sendfile без копирования в Python.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, digest: str, request: Request):
+        self.path = path
+        self.digest = digest
+        self.request = request
+        self.background = None
+        self.status_code = 200
+        self.body = b""
+        self.init_headers({})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        etag = f'"{self.digest}"'
+        try:
+            st = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            await Response(status_code=404)(scope, receive, send)
+            return
+
+        size = st.st_size
+        headers = [
+            (b"etag", etag.encode("latin-1")),
+            (b"cache-control", IMMUTABLE_CACHE_CONTROL.encode("latin-1")),
+            (b"accept-ranges", b"bytes"),
+        ]
+
+        if_none_match = self.request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in
+                              [tag.strip() for tag in if_none_match.split(",")]):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        start, end = 0, size - 1
+        status_code = 200
+        range_header = self.request.headers.get("range")
+        if_range = self.request.headers.get("if-range")
+        if range_header and size and (if_range is None or if_range.strip() == etag):
+            try:
+                parsed = parse_range(range_header, size)
+            except ValueError:
+                headers.append((b"content-range", f"bytes */{size}".encode("latin-1")))
+                await send({"type": "http.response.start", "status": 416, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            if parsed is not None:
+                start, end = parsed
+                status_code = 206
+                headers.append(
+                    (b"content-range", f"bytes {start}-{end}/{size}".encode("latin-1"))
+                )
+
+        count = end - start + 1 if size else 0
+        with open(self.path, "rb") as file:
+            head = read_at(file, 16, 0)
+            headers.append((b"content-type", sniff_media_type(head).encode("latin-1")))
+            headers.append((b"content-length", str(count).encode("latin-1")))
+            await send({"type": "http.response.start", "status": status_code, "headers": headers})
+
+            if scope["method"] == "HEAD" or count == 0:
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": start,
+                    "count": count,
+                    "more_body": False
+                })
+                return
+
+            offset = start
+            while offset <= end:
+                length = min(self.chunk_size, end - offset + 1)
+                chunk = await anyio.to_thread.run_sync(read_at, file, length, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": offset <= end
+                })
+            if offset <= end:
+                await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,169 @@
+"""Фоновые задачи генерации: очередь и пул воркеров внутри процесса"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Статусы задачи
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class JobQueueFull(Exception):
+    """Очередь задач заполнена"""
+
+
+class Job:
+    """Задача генерации и её история событий для SSE"""
+
+    def __init__(self, job_id: str, fn: Callable[[], Awaitable[dict]]):
+        self.id = job_id
+        self.fn = fn
+        self.status = QUEUED
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.finished_monotonic: Optional[float] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.events: List[Tuple[str, dict]] = []
+        self._updated = asyncio.Event()
+
+    def publish(self, event: str, data: dict):
+        self.events.append((event, data))
+        # Будим всех подписчиков и готовим новое событие для следующих
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "result": self.result,
+            "error": self.error
+        }
+
+    async def stream(self, heartbeat: float) -> AsyncIterator[Optional[Tuple[str, dict]]]:
+        """События задачи с начала; None — пора отправить heartbeat"""
+        position = 0
+        while True:
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.status in FINISHED:
+                return
+            updated = self._updated
+            try:
+                await asyncio.wait_for(updated.wait(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+
+
+class JobManager:
+    """Ограниченная очередь задач и фиксированный пул воркеров"""
+
+    def __init__(self, workers: int, max_queue: int, result_ttl: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        # Без новых submit() результаты и история событий иначе не освобождались бы вовсе
+        self._tasks.append(asyncio.create_task(self._purger()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, fn: Callable[[], Awaitable[dict]]) -> Job:
+        if self._queue is None:
+            raise RuntimeError("JobManager не запущен")
+        self._purge()
+        job = Job(f"job_{os.urandom(8).hex()}", fn)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"В очереди уже {self.max_queue} задач") from None
+        self.jobs[job.id] = job
+        job.publish("status", {"status": QUEUED, "position": self._queue.qsize()})
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is not None and self._expired(job, time.monotonic() - self.result_ttl):
+            # Между проходами _purger() просроченную задачу всё равно не отдаём
+            del self.jobs[job_id]
+            return None
+        return job
+
+    @staticmethod
+    def _expired(job: Job, deadline: float) -> bool:
+        return job.finished_monotonic is not None and job.finished_monotonic < deadline
+
+    def _purge(self):
+        """Забывает завершённые задачи старше result_ttl"""
+        deadline = time.monotonic() - self.result_ttl
+        expired = [job_id for job_id, job in self.jobs.items() if self._expired(job, deadline)]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def _purger(self):
+        interval = min(max(self.result_ttl / 2, 1.0), 60.0)
+        while True:
+            await asyncio.sleep(interval)
+            self._purge()
+
+    async def _worker(self, number: int):
+        while True:
+            job: Job = await self._queue.get()
+            self.running += 1
+            job.status = RUNNING
+            job.started_at = datetime.utcnow()
+            job.publish("status", {"status": RUNNING})
+            try:
+                job.result = await job.fn()
+                job.status = SUCCEEDED
+            except asyncio.CancelledError:
+                job.status = FAILED
+                job.error = "Задача отменена при остановке сервера"
+                raise
+            except Exception as e:
+                logger.exception("Задача %s завершилась ошибкой", job.id)
+                job.status = FAILED
+                job.error = str(e)[:500]
+            finally:
+                job.finished_at = datetime.utcnow()
+                job.finished_monotonic = time.monotonic()
+                self.running -= 1
+                self._queue.task_done()
+                job.publish("status", {"status": job.status})
+                job.publish("result" if job.status == SUCCEEDED else "error",
+                            job.result if job.status == SUCCEEDED else {"error": job.error})
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "stored": len(self.jobs)
+        }
@@ -0,0 +1,332 @@
+"""Учёт кредитов в памяти: резерв до генерации, списание или возврат по её итогу
+
+Резерв и списание — операции над словарём без обращения к базе.
+Каждое списание сначала дописывается строкой в журнал процесса, а в базу
+суммы по пользователям переносятся раз в flush_interval одной транзакцией.
+Если процесс упадёт, следующий запуск перенесёт журнал сам; номер
+последней перенесённой записи хранится в базе в той же транзакции,
+поэтому ни одна запись не спишется дважды.
+
+Балансы в памяти у каждого процесса свои: при нескольких воркерах база
+остаётся точной (списания относительные), но перерасход возможен в пределах
+того, что воркеры успели зарезервировать одновременно.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from db import Database, User
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+
+
+class InsufficientCredits(Exception):
+    """Свободных кредитов меньше, чем нужно зарезервировать"""
+
+
+class StaleBalance(Exception):
+    """Строка users прочитана до переноса списаний: баланс в ней устарел, её нужно перечитать"""
+
+
+class Account:
+    """Баланс пользователя в памяти
+
+    balance уже учитывает списания, ещё не перенесённые в базу (pending).
+    """
+
+    __slots__ = ("user_id", "balance", "reserved", "pending", "touched")
+
+    def __init__(self, user_id: int, balance: int):
+        self.user_id = user_id
+        self.balance = balance
+        self.reserved = 0
+        self.pending = 0
+        self.touched = True
+
+    @property
+    def available(self) -> int:
+        return self.balance - self.reserved
+
+
+class Reservation:
+    """Кредиты, отложенные под генерацию; списываются commit(), остаток — release()"""
+
+    __slots__ = ("ledger", "account", "remaining")
+
+    def __init__(self, ledger: "CreditLedger", account: Account, amount: int):
+        self.ledger = ledger
+        self.account = account
+        self.remaining = amount
+
+    @property
+    def user_id(self) -> int:
+        return self.account.user_id
+
+    def commit(self, amount: int) -> bool:
+        """Списать amount из резерва; False — столько не резервировалось"""
+        if amount > self.remaining:
+            return False
+        self.remaining -= amount
+        self.account.reserved -= amount
+        self.ledger._debit(self.account, amount)
+        return True
+
+    def release(self):
+        """Вернуть несписанный остаток; повторный вызов ничего не делает"""
+        if self.remaining:
+            self.account.reserved -= self.remaining
+            self.ledger.refunded += self.remaining
+            self.remaining = 0
+
+    def __del__(self):
+        # Страховка: резерв, про который забыли (клиент ушёл до начала стрима), не висит вечно
+        self.release()
+
+
+class CreditLedger:
+    """Резервы и списания кредитов с журналом и пакетным переносом в базу"""
+
+    def __init__(self, db: Database, journal_dir: str, flush_interval: float = 1.0,
+                 fsync: bool = False):
+        self.db = db
+        self.journal_dir = journal_dir
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.journal_id = uuid.uuid4().hex
+        self.accounts: Dict[int, Account] = {}
+        self._seq = 0
+        self._segment = 0
+        self._fd: Optional[int] = None
+        self._lock_fd: Optional[int] = None
+        # Закрытые сегменты журнала, которые удаляются после успешного переноса
+        self._sealed: List[str] = []
+        self._flush_lock = asyncio.Lock()
+        # Номер переноса: строка users, прочитанная до него, не годится для нового Account
+        self.generation = 0
+        self._task: Optional[asyncio.Task] = None
+        self.commits = 0
+        self.committed = 0
+        self.refunded = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.recovered = 0
+
+    # ---------- горячий путь ----------
+
+    def _account(self, user: User, generation: int) -> Account:
+        account = self.accounts.get(user.id)
+        if account is None:
+            if generation != self.generation:
+                # Пока строка читалась, списания перенесли в базу, а баланс выгрузили из памяти
+                raise StaleBalance(f"Баланс пользователя {user.id} прочитан до переноса")
+            # Баланс из только что прочитанной строки users; дальше память главнее базы
+            account = self.accounts[user.id] = Account(user.id, user.credits)
+        account.touched = True
+        return account
+
+    def available(self, user: User) -> int:
+        account = self.accounts.get(user.id)
+        return account.available if account is not None else user.credits
+
+    def reserve(self, user: User, amount: int, generation: int) -> Reservation:
+        """generation — значение self.generation до чтения строки user из базы"""
+        account = self._account(user, generation)
+        if account.available < amount:
+            self.rejected += 1
+            raise InsufficientCredits(f"Доступно {account.available}, нужно {amount}")
+        account.reserved += amount
+        return Reservation(self, account, amount)
+
+    def _debit(self, account: Account, amount: int):
+        if self._fd is None:
+            raise RuntimeError("Журнал кредитов не открыт: CreditLedger.start() не вызван")
+        self._seq += 1
+        # Одна запись одним write(): после падения процесса строка либо есть целиком, либо её нет
+        os.write(self._fd, f"{self._seq} {account.user_id} {amount}\n".encode())
+        if self.fsync:
+            os.fsync(self._fd)
+        account.balance -= amount
+        account.pending += amount
+        self.commits += 1
+        self.committed += amount
+
+    # ---------- журнал ----------
+
+    def _path(self, journal_id: str, suffix: str, segment: Optional[int] = None) -> str:
+        name = journal_id if segment is None else f"{journal_id}.{segment}"
+        return os.path.join(self.journal_dir, name + suffix)
+
+    def _open_segment(self):
+        self._segment += 1
+        path = self._path(self.journal_id, JOURNAL_SUFFIX, self._segment)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def _seal_segment(self):
+        """Новые списания пишутся в следующий сегмент, текущий ждёт переноса"""
+        os.close(self._fd)
+        self._sealed.append(self._path(self.journal_id, JOURNAL_SUFFIX, self._segment))
+        self._open_segment()
+
+    @staticmethod
+    def _try_lock(path: str) -> Optional[int]:
+        """Открывает и блокирует файл; None — его держит живой процесс"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                # Блокировка первого байта; снимается при закрытии fd или смерти процесса
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _read_entries(paths: List[str]) -> List[Tuple[int, int, int]]:
+        entries = []
+        for path in paths:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        seq, user_id, amount = (int(part) for part in line.split())
+                    except ValueError:
+                        # Оборванная последняя строка: списание не успело состояться
+                        continue
+                    entries.append((seq, user_id, amount))
+        return entries
+
+    async def _recover(self):
+        """Переносит в базу журналы процессов, которые завершились, не успев этого сделать"""
+        if fcntl is None and msvcrt is None:
+            # Живой журнал другого воркера не отличить от брошенного: перенос списал бы дважды
+            logger.warning("Блокировки файлов недоступны: чужие журналы кредитов не переносятся")
+            return
+        segments: Dict[str, List[str]] = {}
+        for name in os.listdir(self.journal_dir):
+            if name.endswith(JOURNAL_SUFFIX):
+                journal_id = name.split(".", 1)[0]
+                segments.setdefault(journal_id, []).append(os.path.join(self.journal_dir, name))
+
+        for journal_id, paths in segments.items():
+            lock_path = self._path(journal_id, LOCK_SUFFIX)
+            lock_fd = self._try_lock(lock_path)
+            if lock_fd is None:
+                continue
+            try:
+                entries = self._read_entries(paths)
+                applied = await self.db.replay_credit_journal(journal_id, entries)
+                for path in paths:
+                    os.remove(path)
+                await self.db.forget_journal(journal_id)
+            except (OSError, sqlite3.Error) as e:
+                logger.error("Журнал кредитов %s не перенесён: %s", journal_id, e)
+                continue
+            finally:
+                os.close(lock_fd)
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            self.recovered += applied
+            if applied:
+                logger.warning("Из журнала %s перенесено %d списаний", journal_id, applied)
+
+    # ---------- перенос в базу ----------
+
+    async def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        await self._recover()
+        self._lock_fd = self._try_lock(self._path(self.journal_id, LOCK_SUFFIX))
+        self._open_segment()
+        self._task = asyncio.create_task(self._flusher())
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Переносит накопленные списания в базу одной транзакцией"""
+        async with self._flush_lock:
+            flushing = [account for account in self.accounts.values() if account.pending]
+            if flushing:
+                deltas = {account.user_id: account.pending for account in flushing}
+                seq = self._seq
+                self._seal_segment()
+                for account in flushing:
+                    account.pending = 0
+                try:
+                    await self.db.charge_credits(self.journal_id, deltas, seq)
+                except sqlite3.Error as e:
+                    # Суммы вернутся в следующий перенос, записи журнала остаются на диске
+                    for account in flushing:
+                        account.pending += deltas[account.user_id]
+                    self.flush_errors += 1
+                    logger.error("Списания кредитов не перенесены в базу: %s", e)
+                    return
+                self.generation += 1
+                self.flushes += 1
+                for path in self._sealed:
+                    os.remove(path)
+                self._sealed.clear()
+            self._evict_idle()
+
+    def _evict_idle(self):
+        """Забывает балансы, не тронутые с прошлого переноса: следующий запрос перечитает базу"""
+        for user_id, account in list(self.accounts.items()):
+            if account.touched:
+                account.touched = False
+            elif not account.reserved and not account.pending:
+                del self.accounts[user_id]
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+        os.close(self._fd)
+        self._fd = None
+        drained = not self._sealed and not any(account.pending for account in self.accounts.values())
+        if drained:
+            # Всё перенесено: журнал и отметка в базе больше не нужны
+            os.remove(self._path(self.journal_id, JOURNAL_SUFFIX, self._segment))
+            await self.db.forget_journal(self.journal_id)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        if drained:
+            # Только после закрытия: открытый файл Windows удалить не даст
+            os.remove(self._path(self.journal_id, LOCK_SUFFIX))
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self.accounts),
+            "reserved": sum(account.reserved for account in self.accounts.values()),
+            "pending": sum(account.pending for account in self.accounts.values()),
+            "commits": self.commits,
+            "committed": self.committed,
+            "refunded": self.refunded,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "recovered": self.recovered
+        }
@@ -0,0 +1,140 @@
+"""Структурированное логирование через очередь: запись в поток-слушатель, JSON, сэмплирование"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import orjson
+
+# request_id текущего запроса; попадает в каждую запись как отдельное поле
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# extra для частых пошаговых строк, которые можно сэмплировать
+STEP = {"step": True}
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "step"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def parse_sample_rates(spec: str) -> Dict[int, float]:
+    """"INFO=0.1,DEBUG=0" -> {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+    rates = {}
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            continue
+        try:
+            rates[level] = min(max(float(value), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет request_id и отбрасывает часть пошаговых записей до постановки в очередь"""
+
+    def __init__(self, sample_rates: Dict[int, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "step", False):
+            rate = self.sample_rates.get(record.levelno, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                self.dropped += 1
+                return False
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в потоке запроса
+
+    Стандартный prepare() склеивает msg % args ещё до очереди; здесь
+    запись уходит как есть, а форматирует её поток-слушатель.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            payload["request_id"] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(payload, default=str).decode("utf-8")
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        return f"[{request_id}] {text}" if request_id else text
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", sample_rates: str = "") -> ContextFilter:
+    """Направляет корневой логгер в очередь, которую разбирает отдельный поток"""
+    global _listener
+    stop_logging()
+
+    if fmt == "json":
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    context_filter = ContextFilter(parse_sample_rates(sample_rates))
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(context_filter)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+    # Логи uvicorn идут через тот же конвейер
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return context_filter
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток-слушатель"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,27 +1,295 @@
-﻿from fastapi import FastAPI, HTTPException
+﻿# Первым импортом: отсчёт времени старта начинается отсюда
+from startup import lazy_import, lazy_import_async, startup_report
+from fastapi import FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import Optional
-from openai import OpenAI
+from typing import List, Optional
+import asyncio
+from contextlib import asynccontextmanager
 import os
+import hmac
 import logging
 from datetime import datetime
-import requests
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+import orjson
+
+import config
+from logging_setup import STEP, request_id_var, setup_logging
+from catalog import PrecomputedResponse
+from engine import ImageEngine
+from rate_limit import UpstreamRateLimiter
+from resilience import CircuitBreaker, RetryPolicy
+from http_pool import HttpPool
+from image_store import DIGEST_RE, ImageFileResponse, ImageStore
+from derivatives import VARIANTS, DerivativeStore
+from result_cache import ResultCache, result_key
+from singleflight import SingleFlight
+from state import create_state_backend
+from db import Database, EmailTakenError, GenerationLog, decode_cursor, encode_cursor
+from ledger import CreditLedger, InsufficientCredits, Reservation, StaleBalance
+from similarity import SimilarPrompt, SimilarityIndex
+from client_cache import key_fingerprint
+from jobs import JobManager, JobQueueFull
+from concurrency import KeyedSemaphore
+from unsplash import SearchResultCache, UnsplashProvider
+from providers import (
+    GENERATE, ImageProvider, OpenAIImageProvider, ProviderJob, ProviderRouter,
+    StaticImageProvider, UnsplashImageProvider
+)
+from metrics import (
+    FALLBACKS, GENERATE_LATENCY, GENERATIONS_IN_FLIGHT, fallback_reason, register_stats
+)
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from timing import span, start_timings
+from profiler import RequestProfiler
+
+startup_report.mark("imports")
+
+# Настройка логирования: запись через очередь, вывод в отдельном потоке
+log_filter = setup_logging(
+    level=config.LOG_LEVEL,
+    fmt=config.LOG_FORMAT,
+    sample_rates=config.LOG_SAMPLE_RATES
 )
 logger = logging.getLogger(__name__)
 
+# Общее хранилище кэшей и лимитов для нескольких воркеров; None — память процесса
+state_backend = create_state_backend(config.STATE_BACKEND, prefix=config.STATE_KEY_PREFIX)
+
+# Пользователи и история: пул соединений SQLite, история пишется пачками в фоне
+database = Database(config.DB_PATH, pool_size=config.DB_POOL_SIZE, busy_timeout=config.DB_BUSY_TIMEOUT)
+generation_log = GenerationLog(
+    database,
+    batch_size=config.GENERATION_LOG_BATCH,
+    flush_interval=config.GENERATION_LOG_FLUSH_INTERVAL,
+    max_queue=config.GENERATION_LOG_MAX_QUEUE
+)
+# Кредиты резервируются в памяти до генерации, списания переносятся в базу пачками
+ledger = CreditLedger(
+    database,
+    journal_dir=config.LEDGER_JOURNAL_DIR,
+    flush_interval=config.LEDGER_FLUSH_INTERVAL,
+    fsync=config.LEDGER_JOURNAL_FSYNC
+)
+
+# Общий движок генерации: один на процесс, ограничивает параллельные вызовы DALL-E
+engine = ImageEngine(
+    max_concurrency=config.OPENAI_MAX_CONCURRENCY,
+    queue_timeout=config.OPENAI_QUEUE_TIMEOUT,
+    request_timeout=config.OPENAI_REQUEST_TIMEOUT,
+    client_cache_size=config.OPENAI_CLIENT_CACHE_SIZE,
+    client_idle_ttl=config.OPENAI_CLIENT_IDLE_TTL,
+    limiter=UpstreamRateLimiter(
+        per_minute=config.OPENAI_IMAGES_PER_MINUTE,
+        wait_budget=config.OPENAI_RATE_WAIT_BUDGET,
+        state=state_backend,
+        namespace="openai"
+    ),
+    breaker=CircuitBreaker(
+        "openai",
+        failure_threshold=config.OPENAI_BREAKER_FAILURES,
+        recovery_timeout=config.OPENAI_BREAKER_RECOVERY,
+        half_open_max_calls=config.OPENAI_BREAKER_HALF_OPEN_CALLS
+    ),
+    retry=RetryPolicy(
+        max_attempts=config.OPENAI_RETRY_ATTEMPTS,
+        base_delay=config.OPENAI_RETRY_BASE_DELAY,
+        max_delay=config.OPENAI_RETRY_MAX_DELAY
+    )
+)
+
+# OpenAI-совместимый бэкенд — отдельный движок со своими лимитами и breaker
+compat_engine = None
+if config.OPENAI_COMPAT_BASE_URL:
+    compat_engine = ImageEngine(
+        max_concurrency=config.OPENAI_MAX_CONCURRENCY,
+        queue_timeout=config.OPENAI_QUEUE_TIMEOUT,
+        request_timeout=config.OPENAI_REQUEST_TIMEOUT,
+        client_cache_size=config.OPENAI_CLIENT_CACHE_SIZE,
+        client_idle_ttl=config.OPENAI_CLIENT_IDLE_TTL,
+        limiter=UpstreamRateLimiter(
+            per_minute=config.OPENAI_COMPAT_IMAGES_PER_MINUTE,
+            wait_budget=config.OPENAI_RATE_WAIT_BUDGET,
+            state=state_backend,
+            namespace="openai_compat"
+        ),
+        breaker=CircuitBreaker(
+            "openai_compat",
+            failure_threshold=config.OPENAI_BREAKER_FAILURES,
+            recovery_timeout=config.OPENAI_BREAKER_RECOVERY,
+            half_open_max_calls=config.OPENAI_BREAKER_HALF_OPEN_CALLS
+        ),
+        retry=RetryPolicy(
+            max_attempts=config.OPENAI_RETRY_ATTEMPTS,
+            base_delay=config.OPENAI_RETRY_BASE_DELAY,
+            max_delay=config.OPENAI_RETRY_MAX_DELAY
+        ),
+        name="openai_compat",
+        base_url=config.OPENAI_COMPAT_BASE_URL,
+        model=config.OPENAI_COMPAT_MODEL,
+        style="vivid" if config.OPENAI_COMPAT_MODEL == "dall-e-3" else None
+    )
+
+# Кэш готовых ответов OpenAI: одинаковые запросы не оплачиваются повторно
+result_cache = ResultCache(
+    enabled=config.RESULT_CACHE_ENABLED,
+    max_size=config.RESULT_CACHE_MAX_SIZE,
+    ttl=config.RESULT_CACHE_TTL,
+    state=state_backend
+)
+
+# Локальная копия сгенерированных изображений: ссылки DALL-E истекают через час
+image_store = ImageStore(config.IMAGE_STORE_DIR)
+
+# Почти одинаковые промпты (порядок слов, пунктуация) получают уже оплаченное изображение
+similar_index = None
+if config.SIMILARITY_ENABLED:
+    similar_index = SimilarityIndex(
+        threshold=config.SIMILARITY_THRESHOLD,
+        max_entries=config.SIMILARITY_MAX_ENTRIES
+    )
+
+async def rebuild_similarity_index():
+    """Индекс похожих промптов из истории: только изображения, лежащие в image_store"""
+    rows = await database.recent_generations(config.SIMILARITY_MAX_ENTRIES)
+    indexable = [
+        row for row in reversed(rows)
+        if "/images/" in row[-1] and image_store.exists(row[-1].rsplit("/", 1)[-1])
+    ]
+    await similar_index.rebuild(indexable)
+    logger.info("Индекс похожих промптов пересобран: %d записей", similar_index.stats()["entries"])
+
+def public_image_url(base_url: str, digest: str) -> str:
+    base_url = config.PUBLIC_BASE_URL or base_url
+    return f"{base_url.rstrip('/')}/images/{digest}"
+
+# Миниатюры и WebP/AVIF: перекодирование в пуле процессов, готовые файлы — на диске
+derivative_store = None
+if config.DERIVATIVES_ENABLED:
+    derivative_store = DerivativeStore(
+        image_store,
+        root=config.DERIVATIVE_DIR,
+        workers=config.DERIVATIVE_WORKERS,
+        eager=[name.strip() for name in config.DERIVATIVE_EAGER.split(",") if name.strip()]
+    )
+    if not derivative_store.available:
+        logger.warning("Pillow не установлен: варианты изображений недоступны")
+        derivative_store = None
+
+def variant_urls(base_url: str, digest: str) -> dict:
+    """Ссылки на варианты сохранённого изображения; строятся при первом обращении"""
+    if derivative_store is None:
+        return {}
+    image_url = public_image_url(base_url, digest)
+    return {name: f"{image_url}/{name}" for name in VARIANTS if derivative_store.supports(name)}
+
+# Одинаковые одновременные запросы делят один вызов OpenAI/Unsplash
+inflight = SingleFlight(
+    state=state_backend,
+    lease_ttl=config.DEDUP_LEASE_TTL,
+    result_ttl=config.DEDUP_RESULT_TTL,
+    poll_interval=config.DEDUP_POLL_INTERVAL
+)
+
+# Пакеты: не больше N одновременных генераций на один ключ
+batch_limiter = KeyedSemaphore(config.BATCH_PER_KEY_CONCURRENCY)
+
+# Асинхронные задачи: POST /jobs сразу отвечает, генерацию выполняет пул воркеров
+job_manager = JobManager(
+    workers=config.JOB_WORKERS,
+    max_queue=config.JOB_MAX_QUEUE,
+    result_ttl=config.JOB_RESULT_TTL
+)
+
+# Общий keep-alive пул соединений к внешним HTTP API (Unsplash и др.)
+http_pool = HttpPool(
+    max_connections=config.HTTP_POOL_MAX_CONNECTIONS,
+    max_keepalive=config.HTTP_POOL_MAX_KEEPALIVE,
+    keepalive_expiry=config.HTTP_POOL_KEEPALIVE_EXPIRY,
+    connect_timeout=config.HTTP_CONNECT_TIMEOUT,
+    timeout=config.HTTP_TIMEOUT
+)
+
+async def warmup():
+    """Догружает отложенное при старте, пока сервис уже принимает запросы"""
+    try:
+        with startup_report.phase("warmup_imports"):
+            for name in ("httpx", "openai"):
+                await lazy_import_async(name)
+        with startup_report.phase("warmup_catalog"):
+            for name in ("styles", "landing"):
+                get_catalog(name)
+        with startup_report.phase("warmup_http_pool"):
+            await http_pool.start()
+    except Exception:
+        logger.exception("Прогрев не удался, загрузка произойдёт при первом запросе")
+    startup_report.ready()
+    logger.info("Прогрев завершён", extra={"startup": startup_report.as_dict()})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = None
+    similarity_task = None
+    with startup_report.phase("lifespan"):
+        if not config.FAST_START:
+            await http_pool.start()
+        await database.start()
+        await job_manager.start()
+        await generation_log.start()
+        await ledger.start()
+        if similar_index is not None:
+            similarity_task = asyncio.create_task(rebuild_similarity_index())
+        # Задача стартует после yield, когда uvicorn уже слушает порт
+        if config.FAST_START and config.STARTUP_WARMUP:
+            warmup_task = asyncio.create_task(warmup())
+    if warmup_task is None:
+        startup_report.ready()
+        logger.info("Сервис запущен", extra={"startup": startup_report.as_dict()})
+    yield
+    for task in (warmup_task, similarity_task):
+        if task is not None and not task.done():
+            task.cancel()
+    await job_manager.stop()
+    await generation_log.stop()
+    await ledger.stop()
+    database.close()
+    await engine.close()
+    if compat_engine is not None:
+        await compat_engine.close()
+    await http_pool.close()
+    if derivative_store is not None:
+        derivative_store.close()
+    if state_backend is not None:
+        await state_backend.close()
+
+# Кэш поиска Unsplash бережёт квоту демо-ключа (50 запросов в час)
+unsplash_cache = SearchResultCache(
+    max_size=config.UNSPLASH_CACHE_MAX_SIZE,
+    ttl=config.UNSPLASH_CACHE_TTL,
+    negative_ttl=config.UNSPLASH_NEGATIVE_TTL,
+    state=state_backend
+)
+
+def get_unsplash(api_key: Optional[str], use_cache: bool = True) -> UnsplashProvider:
+    return UnsplashProvider(
+        api_key,
+        http=http_pool.client,
+        base_url=config.UNSPLASH_API_URL,
+        timeout=config.UNSPLASH_TIMEOUT,
+        cache=unsplash_cache if use_cache else None,
+        per_page=config.UNSPLASH_PER_PAGE
+    )
+
 app = FastAPI(
     title="Illustraitor AI API",
     description="API для генерации изображений через DALL-E 3 с поддержкой Unsplash",
     version="2.1.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -39,77 +307,53 @@ class GenerateRequest(BaseModel):
     style: str = "fantasy"
     api_key: Optional[str] = None
     unsplash_key: Optional[str] = None  # ⬅️ НОВОЕ ПОЛЕ ДЛЯ UNSPLASH
+    user_key: Optional[str] = None  # Ключ сервиса из /register: кредиты и история
+    size: str = "1024x1024"
+    quality: str = "standard"
+    use_cache: bool = True  # False — всегда генерировать заново
+    reuse_similar: Optional[bool] = None  # Вернуть изображение похожего промпта (None — SIMILARITY_REUSE)
+    deadline_ms: Optional[int] = None  # Бюджет ожидания OpenAI, затем демо (или X-Deadline-Ms)
+
+class ProfilerSettings(BaseModel):
+    enabled: bool
+    sample_rate: Optional[float] = None  # Доля профилируемых запросов, 0..1
+    interval_ms: Optional[float] = None  # Период снятия стека
+
+class BatchGenerateRequest(BaseModel):
+    texts: List[str]
+    style: str = "fantasy"
+    api_key: Optional[str] = None
+    unsplash_key: Optional[str] = None
+    user_key: Optional[str] = None
     size: str = "1024x1024"
     quality: str = "standard"
+    use_cache: bool = True
+    reuse_similar: Optional[bool] = None
+
+class UserRegister(BaseModel):
+    email: str
+    name: str
 
 # ========== СТИЛИ ГЕНЕРАЦИИ ==========
 
 STYLES = {
-    "business": {"name": "Бизнес", "prompt": "professional corporate style, clean lines, modern"},
-    "creative": {"name": "Креативный", "prompt": "artistic, imaginative, colorful, abstract"},
-    "minimalist": {"name": "Минимализм", "prompt": "minimalist design, simple lines, monochrome"},
-    "infographic": {"name": "Инфографика", "prompt": "infographic style, data visualization"},
-    "playful": {"name": "Игривый", "prompt": "fun, cartoonish, bright colors, friendly"},
-    "3d_render": {"name": "3D Рендер", "prompt": "3D render, Blender style, cinematic lighting"},
-    "watercolor": {"name": "Акварель", "prompt": "watercolor painting, soft edges, artistic"},
-    "cyberpunk": {"name": "Киберпанк", "prompt": "cyberpunk aesthetic, neon lights, futuristic"},
-    "flat_design": {"name": "Плоский дизайн", "prompt": "flat design, vector illustration"},
-    "oil_painting": {"name": "Масляная живопись", "prompt": "oil painting style, textured brush strokes"},
-    "pixel_art": {"name": "Пиксель-арт", "prompt": "pixel art, retro gaming style, 8-bit"},
-    "anime": {"name": "Аниме", "prompt": "anime style, Japanese animation, vibrant colors"},
-    "sketch": {"name": "Эскиз", "prompt": "sketch drawing, pencil lines, artistic"},
-    "vintage": {"name": "Винтаж", "prompt": "vintage style, retro aesthetic, nostalgic"},
-    "fantasy": {"name": "Фэнтези", "prompt": "fantasy art, magical creatures, mystical"}
+    "business": {"name": "Бизнес", "prompt": "professional corporate style, clean lines, modern", "credits": 1},
+    "creative": {"name": "Креативный", "prompt": "artistic, imaginative, colorful, abstract", "credits": 1},
+    "minimalist": {"name": "Минимализм", "prompt": "minimalist design, simple lines, monochrome", "credits": 1},
+    "infographic": {"name": "Инфографика", "prompt": "infographic style, data visualization", "credits": 1},
+    "playful": {"name": "Игривый", "prompt": "fun, cartoonish, bright colors, friendly", "credits": 1},
+    "3d_render": {"name": "3D Рендер", "prompt": "3D render, Blender style, cinematic lighting", "credits": 2},
+    "watercolor": {"name": "Акварель", "prompt": "watercolor painting, soft edges, artistic", "credits": 2},
+    "cyberpunk": {"name": "Киберпанк", "prompt": "cyberpunk aesthetic, neon lights, futuristic", "credits": 2},
+    "flat_design": {"name": "Плоский дизайн", "prompt": "flat design, vector illustration", "credits": 1},
+    "oil_painting": {"name": "Масляная живопись", "prompt": "oil painting style, textured brush strokes", "credits": 2},
+    "pixel_art": {"name": "Пиксель-арт", "prompt": "pixel art, retro gaming style, 8-bit", "credits": 1},
+    "anime": {"name": "Аниме", "prompt": "anime style, Japanese animation, vibrant colors", "credits": 2},
+    "sketch": {"name": "Эскиз", "prompt": "sketch drawing, pencil lines, artistic", "credits": 1},
+    "vintage": {"name": "Винтаж", "prompt": "vintage style, retro aesthetic, nostalgic", "credits": 1},
+    "fantasy": {"name": "Фэнтези", "prompt": "fantasy art, magical creatures, mystical", "credits": 2}
 }
 
-# ========== UNSPLASH PROVIDER ==========
-
-class UnsplashProvider:
-    """Поиск изображений через Unsplash API"""
-    
-    def __init__(self, api_key: Optional[str] = None):
-        self.api_key = api_key
-        self.base_url = "https://api.unsplash.com"
-    
-    def search_image(self, query: str, style_prompt: str) -> Optional[str]:
-        """Ищет релевантное изображение в Unsplash"""
-        if not self.api_key:
-            return None
-        
-        try:
-            # Комбинируем промпт стиля и запрос пользователя
-            search_query = f"{style_prompt} {query}"
-            
-            headers = {
-                "Authorization": f"Client-ID {self.api_key}",
-                "Accept-Version": "v1"
-            }
-            
-            params = {
-                "query": search_query[:100],  # Ограничиваем длину
-                "per_page": 1,
-                "orientation": "squarish",
-                "content_filter": "high"
-            }
-            
-            response = requests.get(
-                f"{self.base_url}/search/photos",
-                headers=headers,
-                params=params,
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("results") and len(data["results"]) > 0:
-                    logger.info(f"Unsplash found image for: {search_query}")
-                    return data["results"][0]["urls"]["regular"]
-            
-        except Exception as e:
-            logger.warning(f"Unsplash API error: {str(e)[:100]}")
-        
-        return None
-
 # ========== ДЕМО ИЗОБРАЖЕНИЯ ==========
 
 DEMO_IMAGES = {
@@ -122,15 +366,92 @@ DEMO_IMAGES = {
     "default": "https://images.unsplash.com/photo-1519681393784-d120267933ba"
 }
 
-# ========== КРИТИЧЕСКИ ВАЖНЫЕ ЭНДПОИНТЫ ==========
+# ========== ПРОВАЙДЕРЫ ==========
 
-@app.head("/")
-async def head_root():
-    """HEAD запрос для Render health checks"""
-    return
+# Порядок источников задают политики, а внутри группы — живые EWMA-показатели
+image_providers = [
+    OpenAIImageProvider("openai", engine, request_key=True),
+    UnsplashImageProvider("unsplash", get_unsplash),
+    StaticImageProvider("static", DEMO_IMAGES)
+]
+if compat_engine is not None:
+    if not config.OPENAI_COMPAT_API_KEY:
+        logger.warning("OPENAI_COMPAT_API_KEY не задан: провайдер openai_compat недоступен")
+    image_providers.append(
+        OpenAIImageProvider("openai_compat", compat_engine, api_key=config.OPENAI_COMPAT_API_KEY)
+    )
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
+router = ProviderRouter(
+    image_providers,
+    tier_policies={"pro": config.ROUTING_POLICY_PRO, "free": config.ROUTING_POLICY_FREE},
+    style_policies=config.ROUTING_STYLE_POLICIES,
+    alpha=config.ROUTING_EWMA_ALPHA,
+    error_penalty=config.ROUTING_ERROR_PENALTY,
+    explore_rate=config.ROUTING_EXPLORE_RATE
+)
+
+# Выборочное профилирование запросов, включается через /admin/profiler
+profiler = RequestProfiler(config.PROFILE_DIR)
+
+# Состояние кэшей и очередей читается при каждом scrape /metrics
+register_stats("illustraitor_cache", {
+    "result": result_cache.stats,
+    "unsplash_search": unsplash_cache.stats,
+    "openai_clients": engine.clients.stats
+})
+if derivative_store is not None:
+    register_stats("illustraitor_derivatives", {"images": derivative_store.stats})
+if similar_index is not None:
+    register_stats("illustraitor_similarity", {"prompts": similar_index.stats})
+register_stats("illustraitor_provider", {
+    name: health.as_dict for name, health in router.health.items()
+})
+register_stats("illustraitor_db", {
+    "pool": database.pool.stats,
+    "generation_log": generation_log.stats,
+    "ledger": ledger.stats
+})
+register_stats("illustraitor_startup", {"main": startup_report.as_dict})
+register_stats("illustraitor_queue", {
+    "engine": engine.stats,
+    "jobs": job_manager.stats,
+    "coalescing": inflight.stats
+})
+
+# ========== ПРЕДВЫЧИСЛЕННЫЕ ОТВЕТЫ ==========
+
+# Каталог стилей и главная страница меняются только вместе с кодом:
+# сериализуем их один раз и отдаём готовые байты с ETag.
+# В режиме FAST_START сборка откладывается до прогрева или первого запроса
+CATALOG_CACHE_CONTROL = "public, max-age=86400"
+catalog = {}
+
+def get_catalog(name: str) -> PrecomputedResponse:
+    if name not in catalog:
+        rebuild_catalog()
+    return catalog[name]
+
+def rebuild_catalog():
+    """Пересобирает /styles и главную страницу; вызывать при изменении STYLES"""
+    built_at = datetime.utcnow()
+    styles_list = []
+    for key, value in STYLES.items():
+        styles_list.append({
+            "id": key,
+            "name": value["name"],
+            "description": value["prompt"],
+            "credits_cost": value["credits"],
+            "demo_image": DEMO_IMAGES.get(key, DEMO_IMAGES["default"])
+        })
+    
+    catalog["styles"] = PrecomputedResponse.json({
+        "status": "success",
+        "styles": styles_list, 
+        "total": len(styles_list),
+        "timestamp": built_at.isoformat(),
+        "note": "Для генерации используйте POST /generate"
+    }, CATALOG_CACHE_CONTROL)
+    
     html_content = f"""
     <!DOCTYPE html>
     <html>
@@ -145,49 +466,101 @@ async def root():
         <div class="container">
             <h1>🚀 Illustraitor AI API</h1>
             <p>Версия: 2.1.0 | Статус: ✅ Работает</p>
-            <p>Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+            <p>Запущен: {built_at.strftime('%Y-%m-%d %H:%M:%S')} UTC</p>
             <p><strong>Поддержка:</strong> OpenAI DALL-E 3 + Unsplash API</p>
             <p><a href="/docs">📖 Swagger документация</a></p>
         </div>
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+    catalog["landing"] = PrecomputedResponse.html(html_content, CATALOG_CACHE_CONTROL)
+
+if not config.FAST_START:
+    # Полная загрузка при старте: клиенты библиотек и каталог готовы к первому запросу
+    for name in ("httpx", "openai"):
+        lazy_import(name)
+    rebuild_catalog()
+
+# ========== КРИТИЧЕСКИ ВАЖНЫЕ ЭНДПОИНТЫ ==========
+
+@app.head("/")
+async def head_root():
+    """HEAD запрос для Render health checks"""
+    return
+
+@app.get("/", response_class=HTMLResponse)
+async def root(http_request: Request):
+    return get_catalog("landing").respond(http_request)
 
 @app.get("/health")
 async def health_check():
-    return JSONResponse({
+    return {
         "status": "healthy",
         "service": "illustraitor-ai",
         "version": "2.1.0",
         "timestamp": datetime.utcnow().isoformat(),
-        "features": ["openai", "unsplash", "15_styles"]
-    })
+        "features": ["openai", "unsplash", "15_styles"],
+        "engine": engine.stats(),
+        "compat_engine": compat_engine.stats() if compat_engine is not None else None,
+        "providers": router.stats(),
+        "result_cache": result_cache.stats(),
+        "unsplash_cache": unsplash_cache.stats(),
+        "coalescing": inflight.stats(),
+        "jobs": job_manager.stats(),
+        "batch": batch_limiter.stats(),
+        "state": state_backend.stats() if state_backend is not None else {"backend": "memory"},
+        "database": database.stats(),
+        "generation_log": generation_log.stats(),
+        "ledger": ledger.stats(),
+        "similarity": similar_index.stats() if similar_index is not None else None,
+        "derivatives": derivative_store.stats() if derivative_store is not None else None,
+        "logging": {"sampled_out": log_filter.dropped},
+        "profiler": profiler.stats(),
+        "startup": startup_report.as_dict()
+    }
+
+def require_admin(token: Optional[str]):
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, config.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Неверный токен администратора")
+
+@app.get("/admin/profiler", include_in_schema=False)
+async def get_profiler(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    return profiler.stats()
+
+@app.post("/admin/profiler", include_in_schema=False)
+async def set_profiler(settings: ProfilerSettings, x_admin_token: Optional[str] = Header(None)):
+    """Включить выборочное профилирование /generate; профили пишутся в PROFILE_DIR"""
+    require_admin(x_admin_token)
+    profiler.configure(settings.enabled, settings.sample_rate, settings.interval_ms)
+    logger.info("Профайлер: %s", profiler.stats())
+    return profiler.stats()
+
+@app.post("/admin/similarity/rebuild", include_in_schema=False)
+async def rebuild_similarity(x_admin_token: Optional[str] = Header(None)):
+    """Пересобрать индекс похожих промптов из таблицы generations"""
+    require_admin(x_admin_token)
+    if similar_index is None:
+        raise HTTPException(status_code=409, detail="Индекс похожих промптов выключен (SIMILARITY_ENABLED)")
+    await rebuild_similarity_index()
+    return similar_index.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 # ========== ОСНОВНЫЕ ЭНДПОИНТЫ API ==========
 
 @app.get("/styles")
-async def get_styles():
+async def get_styles(http_request: Request):
     """Получить список всех доступных стилей генерации"""
-    styles_list = []
-    for key, value in STYLES.items():
-        styles_list.append({
-            "id": key,
-            "name": value["name"],
-            "description": value["prompt"],
-            "demo_image": DEMO_IMAGES.get(key, DEMO_IMAGES["default"])
-        })
-    
-    return {
-        "status": "success",
-        "styles": styles_list, 
-        "total": len(styles_list),
-        "timestamp": datetime.utcnow().isoformat(),
-        "note": "Для генерации используйте POST /generate"
-    }
+    return get_catalog("styles").respond(http_request)
 
 @app.post("/generate")
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request, response: Response):
     """
     Основной эндпоинт генерации изображений
     Поддерживает три режима: 
@@ -196,18 +569,53 @@ async def generate(request: GenerateRequest):
     - Базовая демо (без ключей)
     """
     start_time = datetime.now()
-    request_id = f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(2).hex()}"
+    timings = start_timings()
+    request_id = new_request_id()
+    async with profiler.profile(request_id):
+        with span("validation"):
+            apply_deadline_header(request, http_request)
+            prepare_generation(request, request_id)
+            reservation = await reserve_credits(request.user_key, STYLES[request.style]["credits"])
+        try:
+            result = await generate_shared(request, request_id, start_time,
+                                           str(http_request.base_url), reservation)
+        finally:
+            if reservation is not None:
+                reservation.release()
     
-    logger.info(f"[{request_id}] === НАЧАЛО GENERATE ===")
-    logger.info(f"[{request_id}] Текст: {request.text[:50]}...")
-    logger.info(f"[{request_id}] Стиль: {request.style}")
-    logger.info(f"[{request_id}] OpenAI ключ: {'Да' if request.api_key else 'Нет'}")
-    logger.info(f"[{request_id}] Unsplash ключ: {'Да' if request.unsplash_key else 'Нет'}")
+    response.headers["Server-Timing"] = timings.header()
+    logger.info("Generate завершён", extra={"mode": result.get("mode"), "timings": timings.as_dict()})
+    return result
+
+def new_request_id() -> str:
+    return f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(2).hex()}"
+
+def apply_deadline_header(request: GenerateRequest, http_request: Request):
+    """Дедлайн из заголовка X-Deadline-Ms, если он не задан в теле"""
+    header = http_request.headers.get("x-deadline-ms")
+    if request.deadline_ms is None and header:
+        try:
+            request.deadline_ms = int(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Deadline-Ms должен быть целым числом")
+    if request.deadline_ms is not None and request.deadline_ms <= 0:
+        request.deadline_ms = None
+
+def prepare_generation(request: GenerateRequest, request_id: str):
+    """Логирование и проверка запроса до постановки генерации"""
+    request_id_var.set(request_id)
+    logger.info("Начало generate", extra={
+        "step": True,
+        "text": request.text[:50],
+        "style": request.style,
+        "openai_key": bool(request.api_key),
+        "unsplash_key": bool(request.unsplash_key)
+    })
     
     # Проверка стиля
     if request.style not in STYLES:
         available_styles = list(STYLES.keys())
-        logger.error(f"[{request_id}] Неверный стиль: {request.style}. Доступные: {available_styles}")
+        logger.error("Неверный стиль: %s", request.style)
         raise HTTPException(
             status_code=400,
             detail={
@@ -224,73 +632,302 @@ async def generate(request: GenerateRequest):
         if var in os.environ:
             del os.environ[var]
     os.environ['NO_PROXY'] = '*'
+
+async def reserve_credits(user_key: Optional[str], credits_needed: int) -> Optional[Reservation]:
+    """Резерв кредитов пользователя по ключу сервиса; освобождает вызывающий"""
+    if not user_key:
+        return None
+    while True:
+        generation = ledger.generation
+        user = await database.get_user(user_key)
+        if user is None:
+            raise HTTPException(status_code=401, detail="Неверный ключ пользователя")
+        try:
+            return ledger.reserve(user, credits_needed, generation)
+        except StaleBalance:
+            # Перенос списаний случился во время чтения — перечитываем строку
+            continue
+        except InsufficientCredits:
+            raise HTTPException(status_code=402, detail="Недостаточно кредитов")
+
+def record_generation(reservation: Reservation, request: GenerateRequest, result: dict) -> dict:
+    """Списание из резерва за AI-генерацию и запись в историю; демо бесплатно"""
+    credits_used = 0
+    if result.get("mode") == "openai":
+        cost = STYLES[request.style]["credits"]
+        if reservation.commit(cost):
+            credits_used = cost
+        else:
+            logger.warning("Резерв исчерпан: пользователь %s", reservation.user_id)
+    generation_log.add(reservation.user_id, request.text, request.style, request.size,
+                       request.quality, result.get("image_url"), credits_used)
+    return dict(result, credits_used=credits_used)
+
+async def generate_shared(request: GenerateRequest, request_id: str,
+                          start_time: datetime, base_url: str,
+                          reservation: Optional[Reservation] = None) -> dict:
+    """run_generation с объединением идентичных одновременных запросов"""
+    GENERATIONS_IN_FLIGHT.inc()
+    try:
+        result, shared = await inflight.do(
+            generation_key(request),
+            lambda: run_generation(request, request_id, start_time, base_url)
+        )
+    finally:
+        GENERATIONS_IN_FLIGHT.dec()
+    if result.get("mode") == "openai":
+        source = "cache" if result.get("cached") else "upstream"
+    else:
+        source = result.get("demo_source", "default_fallback")
+    GENERATE_LATENCY.labels(result.get("mode", "demo"), source).observe(
+        (datetime.now() - start_time).total_seconds()
+    )
+    if shared:
+        logger.info("Объединён с идентичным запросом %s", result["request_id"], extra=STEP)
+        result = dict(result, request_id=request_id, coalesced=True)
+    if reservation is not None:
+        result = record_generation(reservation, request, result)
+    return result
+
+def generation_key(request: GenerateRequest) -> str:
+    """Ключ идентичности запроса для объединения одновременных вызовов"""
+    parts = (
+        request.text,
+        request.style,
+        request.size,
+        request.quality,
+        key_fingerprint(request.api_key) if request.api_key else "",
+        key_fingerprint(request.unsplash_key) if request.unsplash_key else "",
+        "cache" if request.use_cache else "no-cache",
+        str(request.reuse_similar),
+        str(request.deadline_ms or "")
+    )
+    return key_fingerprint("\x1f".join(parts))
+
+def provider_job(request: GenerateRequest) -> ProviderJob:
+    style_prompt = STYLES[request.style]['prompt']
+    return ProviderJob(
+        text=request.text,
+        style=request.style,
+        style_prompt=style_prompt,
+        prompt=f"{style_prompt}: {request.text}",
+        size=request.size,
+        quality=request.quality,
+        api_key=request.api_key,
+        unsplash_key=request.unsplash_key,
+        response_format="b64_json" if config.IMAGE_STORE_ENABLED else "url"
+    )
+
+async def run_generation(request: GenerateRequest, request_id: str,
+                         start_time: datetime, base_url: str) -> dict:
+    """Генерация для проверенного запроса: провайдеры в порядке роутера, затем демо-режим"""
+    job = provider_job(request)
+    providers = router.route(job, "pro" if request.api_key else "free")
+    generators = [provider for provider in providers if provider.mode == GENERATE]
+    finders = [provider for provider in providers if provider.mode != GENERATE]
     
     # ========== РЕЖИМ OPENAI ==========
-    if request.api_key:
-        logger.info(f"[{request_id}] Режим: OPENAI")
+    if generators:
+        logger.info("Режим: OPENAI (%s)", ", ".join(p.name for p in generators), extra=STEP)
+        cache_key = result_key(
+            STYLES[request.style]['prompt'], request.text, request.size, request.quality
+        )
+        if request.use_cache:
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Результат взят из кэша", extra=STEP)
+                cached.update({"cached": True, "request_id": request_id})
+                return cached
+        
+        similar = None
+        if similar_index is not None and request.use_cache:
+            similar = similar_index.lookup(request.style, request.size, request.quality, request.text)
+            reuse = config.SIMILARITY_REUSE if request.reuse_similar is None else request.reuse_similar
+            if similar is not None and reuse:
+                logger.info("Похожий промпт (%.2f): %.50s", similar.similarity, similar.text, extra=STEP)
+                return similar_result(request, request_id, start_time, base_url, similar)
+        
+        if request.deadline_ms:
+            result = await run_hedged(request, job, request_id, start_time, base_url,
+                                      cache_key, generators, finders)
+        else:
+            result = await run_openai(request, job, request_id, start_time, base_url,
+                                      cache_key, generators)
+        if result is not None:
+            # Найденное, но не использованное изображение предлагаем клиенту
+            return dict(result, similar=similar._asdict()) if similar is not None else result
+        
+        # При ошибке всех генераторов переходим в демо-режим
+        logger.info("Переход в демо-режим после ошибки OpenAI")
+    
+    return await run_demo(request, job, request_id, start_time, finders)
+
+def similar_result(request: GenerateRequest, request_id: str, start_time: datetime,
+                   base_url: str, similar: SimilarPrompt) -> dict:
+    """Ответ изображением, сгенерированным ранее для похожего промпта"""
+    # В индекс попадают только изображения из image_store: последний сегмент ссылки — digest
+    image_digest = similar.image_url.rsplit("/", 1)[-1]
+    return {
+        "status": "success",
+        "mode": "openai",
+        "image_url": similar.image_url,
+        "message": f"AI иллюстрация в стиле '{STYLES[request.style]['name']}' (похожий запрос)",
+        "style": request.style,
+        "style_name": STYLES[request.style]["name"],
+        "size": request.size,
+        "quality": request.quality,
+        "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
+        "model": None,
+        "provider": "similarity",
+        "request_id": request_id,
+        "image_digest": image_digest,
+        "variants": variant_urls(base_url, image_digest),
+        "similar_to": similar._asdict(),
+        "cached": True
+    }
+
+async def run_openai(request: GenerateRequest, job: ProviderJob, request_id: str,
+                     start_time: datetime, base_url: str, cache_key: str,
+                     providers: List[ImageProvider]) -> Optional[dict]:
+    """Генерация первым ответившим провайдером; None — все упали, нужен демо-режим"""
+    logger.info("Сформированный промпт: %.100s", job.prompt, extra=STEP)
+    last_error = None
+    for provider in providers:
         try:
-            client = OpenAI(api_key=request.api_key)
-            logger.info(f"[{request_id}] Клиент OpenAI создан успешно")
-            
-            prompt = f"{STYLES[request.style]['prompt']}: {request.text}"
-            logger.info(f"[{request_id}] Формированный промпт: {prompt[:100]}...")
-            
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=prompt[:4000],
-                size=request.size,
-                quality=request.quality,
-                n=1,
-                style="vivid"
-            )
-            
-            image_url = response.data[0].url
-            logger.info(f"[{request_id}] OpenAI успешно: {image_url[:50]}...")
-            
-            return {
-                "status": "success",
-                "mode": "openai",
-                "image_url": image_url,
-                "message": f"AI иллюстрация в стиле '{STYLES[request.style]['name']}'",
-                "style": request.style,
-                "style_name": STYLES[request.style]["name"],
-                "size": request.size,
-                "quality": request.quality,
-                "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
-                "model": "dall-e-3",
-                "request_id": request_id,
-                "prompt_used": prompt[:200]
-            }
-            
+            image = await router.call(provider, job)
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"[{request_id}] Ошибка OpenAI: {error_msg}")
-            
-            # При ошибке OpenAI переходим в демо-режим
-            logger.info(f"[{request_id}] Переход в демо-режим после ошибки OpenAI")
+            logger.error("Ошибка %s: %s", provider.name, e,
+                         extra={"error_type": type(e).__name__, "provider": provider.name})
+            last_error = e
+            continue
+        if image is None:
+            continue
+        
+        with span("response"):
+            image_digest = None
+            variants = {}
+            if image.data is not None:
+                image_digest = await image_store.put(image.data)
+                image_url = public_image_url(base_url, image_digest)
+                variants = variant_urls(base_url, image_digest)
+                if derivative_store is not None:
+                    derivative_store.schedule(image_digest)
+            else:
+                image_url = image.url
+        
+        logger.info("%s успешно: %.50s", provider.name, image_url, extra=STEP)
+        
+        result = {
+            "status": "success",
+            "mode": "openai",
+            "image_url": image_url,
+            "message": f"AI иллюстрация в стиле '{STYLES[request.style]['name']}'",
+            "style": request.style,
+            "style_name": STYLES[request.style]["name"],
+            "size": request.size,
+            "quality": request.quality,
+            "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
+            "model": provider.model,
+            "provider": provider.name,
+            "request_id": request_id,
+            "prompt_used": job.prompt[:200],
+            "image_digest": image_digest,
+            "variants": variants,
+            "cached": False
+        }
+        await result_cache.put(cache_key, result)
+        if similar_index is not None and image_digest is not None:
+            similar_index.add(request.style, request.size, request.quality, request.text, image_url)
+        return result
+    
+    FALLBACKS.labels(fallback_reason(last_error) if last_error else "no_result").inc()
+    return None
+
+# Генерации OpenAI, проигравшие гонку, но дорабатывающие ради кэша
+background_tasks = set()
+
+def keep_in_background(task: asyncio.Task, request_id: str):
+    """Задача доработает после ответа; её исключение забирается и пишется в лог с request_id"""
+    background_tasks.add(task)
     
+    def done(task: asyncio.Task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            logger.error("Фоновая генерация OpenAI упала: %s", error,
+                         extra={"request_id": request_id, "error_type": type(error).__name__})
+    
+    task.add_done_callback(done)
+
+async def run_hedged(request: GenerateRequest, job: ProviderJob, request_id: str,
+                     start_time: datetime, base_url: str, cache_key: str,
+                     generators: List[ImageProvider], finders: List[ImageProvider]) -> dict:
+    """
+    OpenAI и демо-кандидат готовятся параллельно: если OpenAI не успел
+    к дедлайну или упал, сразу отдаём демо вместо последовательного fallback
+    """
+    openai_task = asyncio.ensure_future(
+        run_openai(request, job, request_id, start_time, base_url, cache_key, generators)
+    )
+    demo_task = asyncio.ensure_future(run_demo(request, job, request_id, start_time, finders))
+    try:
+        await asyncio.wait({openai_task}, timeout=request.deadline_ms / 1000.0)
+        if openai_task.done():
+            error = openai_task.exception()
+            if error is None and openai_task.result() is not None:
+                return openai_task.result()
+            if error is not None:
+                # Сбой до дедлайна — тот же fallback на демо, а не ошибка запроса
+                logger.error("Генерация OpenAI упала: %s", error,
+                             extra={"error_type": type(error).__name__})
+        
+        result = await demo_task
+    except BaseException:
+        openai_task.cancel()
+        raise
+    finally:
+        if not demo_task.done():
+            demo_task.cancel()
+            await asyncio.gather(demo_task, return_exceptions=True)
+    
+    if not openai_task.done():
+        FALLBACKS.labels("deadline").inc()
+        if result_cache.enabled and request.use_cache:
+            # Оплаченная генерация доработает в фоне и попадёт в кэш
+            logger.info("Дедлайн %s мс истёк, OpenAI дорабатывает в фоне", request.deadline_ms)
+            keep_in_background(openai_task, request_id)
+        else:
+            logger.info("Дедлайн %s мс истёк, OpenAI отменён", request.deadline_ms)
+            openai_task.cancel()
+    
+    return dict(result, hedged=True)
+
+async def run_demo(request: GenerateRequest, job: ProviderJob, request_id: str,
+                   start_time: datetime, providers: List[ImageProvider]) -> dict:
+    """Демо-режим: Unsplash по ключу или статичное изображение стиля"""
     # ========== ДЕМО РЕЖИМ ==========
-    logger.info(f"[{request_id}] Режим: ДЕМО")
+    logger.info("Режим: ДЕМО", extra=STEP)
     
-    # Получаем изображение для демо-режима
+    # Изображение по умолчанию, если ни один провайдер ничего не дал
     demo_image_url = DEMO_IMAGES.get(request.style, DEMO_IMAGES["default"])
     search_source = "default_fallback"
     
-    # Пробуем найти через Unsplash если есть ключ
-    if request.unsplash_key:
-        unsplash = UnsplashProvider(request.unsplash_key)
-        found_image = unsplash.search_image(
-            request.text, 
-            STYLES[request.style]['prompt']
-        )
+    for provider in providers:
+        try:
+            image = await router.call(provider, job)
+        except Exception as e:
+            logger.warning("Ошибка %s: %.100s", provider.name, e, extra={"provider": provider.name})
+            continue
+        if image is None:
+            search_source = f"{provider.name}_fallback"
+            logger.info("%s не нашел изображение, используется fallback", provider.name, extra=STEP)
+            continue
         
-        if found_image:
-            demo_image_url = found_image
-            search_source = "unsplash"
-            logger.info(f"[{request_id}] Используется Unsplash изображение")
-        else:
-            search_source = "unsplash_fallback"
-            logger.info(f"[{request_id}] Unsplash не нашел изображение, используется fallback")
+        demo_image_url = image.url
+        if not provider.fallback:
+            search_source = provider.name
+            logger.info("Используется %s изображение", provider.name, extra=STEP)
+        break
     
     width, height = request.size.split('x')
     
@@ -308,12 +945,255 @@ async def generate(request: GenerateRequest):
         "note": "Для AI генерации укажите ваш OpenAI API ключ"
     }
 
+def batch_limit_key(request: BatchGenerateRequest, http_request: Request) -> str:
+    """Чей лимит параллельности расходует пакет: ключ OpenAI, иначе сам клиент"""
+    if request.api_key:
+        return key_fingerprint(request.api_key)
+    # Без OpenAI-ключа пакеты разных клиентов не должны делить один набор слотов
+    if request.user_key:
+        return "user:" + key_fingerprint(request.user_key)
+    if request.unsplash_key:
+        return "unsplash:" + key_fingerprint(request.unsplash_key)
+    client = http_request.client
+    return f"ip:{client.host}" if client is not None else "demo"
+
+@app.post("/batch-generate")
+async def batch_generate(request: BatchGenerateRequest, http_request: Request):
+    """
+    Пакетная генерация: тексты генерируются параллельно,
+    каждый результат отдаётся строкой NDJSON сразу по готовности
+    """
+    batch_id = new_request_id().replace("req_", "batch_", 1)
+    if not request.texts:
+        raise HTTPException(status_code=400, detail="Список texts пуст")
+    if len(request.texts) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Максимум {config.BATCH_MAX_ITEMS} изображений за раз"
+        )
+    
+    items = [
+        GenerateRequest(
+            text=text,
+            style=request.style,
+            api_key=request.api_key,
+            unsplash_key=request.unsplash_key,
+            user_key=request.user_key,
+            size=request.size,
+            quality=request.quality,
+            use_cache=request.use_cache,
+            reuse_similar=request.reuse_similar
+        )
+        for text in request.texts
+    ]
+    prepare_generation(items[0], batch_id)
+    # Резерв сразу на весь пакет: параллельные пакеты одного пользователя не уйдут в минус
+    reservation = await reserve_credits(request.user_key, STYLES[request.style]["credits"] * len(items))
+    logger.info("Пакет из %d текстов", len(items))
+    
+    base_url = str(http_request.base_url)
+    limit_key = batch_limit_key(request, http_request)
+    
+    async def run_item(index: int, item: GenerateRequest):
+        request_id = f"{batch_id}_{index}"
+        request_id_var.set(request_id)
+        async with batch_limiter.hold(limit_key):
+            try:
+                result = await generate_shared(item, request_id, datetime.now(), base_url, reservation)
+            except Exception as e:
+                logger.error("Ошибка в пакете: %s", e)
+                result = {"status": "error", "error": str(e)[:200], "request_id": request_id}
+        return dict(result, index=index, text=item.text)
+    
+    tasks: List[asyncio.Task] = []
+    
+    async def finish():
+        # Выполняется и после отключения клиента, даже если стрим так и не начался
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if reservation is not None:
+            reservation.release()
+    
+    async def stream():
+        started = datetime.now()
+        tasks.extend(asyncio.ensure_future(run_item(i, item)) for i, item in enumerate(items))
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if result.get("status") == "success":
+                    succeeded += 1
+                yield orjson.dumps(result) + b"\n"
+        finally:
+            # Клиент отключился — незавершённые генерации больше не нужны
+            for task in tasks:
+                task.cancel()
+        yield orjson.dumps({
+            "status": "done",
+            "batch_id": batch_id,
+            "total": len(items),
+            "succeeded": succeeded,
+            "failed": len(items) - succeeded,
+            "elapsed": round((datetime.now() - started).total_seconds(), 2)
+        }) + b"\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson",
+                             background=BackgroundTask(finish))
+
+# ========== ПОЛЬЗОВАТЕЛИ ==========
+
+@app.post("/register")
+async def register(user: UserRegister):
+    """Регистрация: ключ сервиса для user_key и стартовые кредиты"""
+    try:
+        created, user_key = await database.create_user(user.email, user.name, config.NEW_USER_CREDITS)
+    except EmailTakenError:
+        raise HTTPException(status_code=400, detail="Email уже зарегистрирован")
+    logger.info("Зарегистрирован пользователь %s", created.id)
+    return {
+        "status": "success",
+        "message": "Регистрация успешна",
+        "api_key": user_key,
+        "credits": created.credits,
+        "user_id": created.id
+    }
+
+@app.get("/credits/{user_key}")
+async def get_credits(user_key: str):
+    """Текущий баланс кредитов пользователя"""
+    user = await database.get_user(user_key)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return {
+        "credits": ledger.available(user),
+        "email": user.email,
+        "name": user.name
+    }
+
+@app.get("/history")
+async def get_history(user_key: str, limit: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None,
+                      q: Optional[str] = None, style: Optional[str] = None):
+    """
+    История генераций пользователя от новых к старым
+    - cursor: next_cursor предыдущей страницы
+    - q: поиск по тексту промпта (все слова, последнее — по началу)
+    - style: один или несколько стилей через запятую
+    """
+    user = await database.get_user(user_key)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    styles = [name.strip() for name in style.split(",") if name.strip()] if style else None
+    limit = min(limit or config.HISTORY_PAGE_SIZE, config.HISTORY_MAX_PAGE_SIZE)
+    
+    # Лишняя строка показывает, есть ли следующая страница, без отдельного COUNT
+    items = await database.history(user.id, limit + 1, before, q, styles)
+    has_more = len(items) > limit
+    items = items[:limit]
+    return {
+        "status": "success",
+        "items": [item._asdict() for item in items],
+        "has_more": has_more,
+        "next_cursor": encode_cursor(items[-1]) if has_more else None
+    }
+
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: GenerateRequest, http_request: Request):
+    """Поставить генерацию в очередь; результат — через GET /jobs/{id} или SSE"""
+    request_id = new_request_id()
+    apply_deadline_header(request, http_request)
+    prepare_generation(request, request_id)
+    reservation = await reserve_credits(request.user_key, STYLES[request.style]["credits"])
+    base_url = str(http_request.base_url)
+    
+    async def run() -> dict:
+        request_id_var.set(request_id)
+        try:
+            return await generate_shared(request, request_id, datetime.now(), base_url, reservation)
+        finally:
+            if reservation is not None:
+                reservation.release()
+    
+    try:
+        job = job_manager.submit(run)
+    except JobQueueFull as e:
+        if reservation is not None:
+            reservation.release()
+        raise HTTPException(
+            status_code=503,
+            detail={"status": "error", "error": str(e), "request_id": request_id},
+            headers={"Retry-After": "5"}
+        )
+    
+    logger.info("Поставлена задача %s", job.id)
+    return {
+        "status": "accepted",
+        "job_id": job.id,
+        "job_status": job.status,
+        "request_id": request_id,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }
+
+def get_job_or_404(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Состояние задачи и результат после завершения"""
+    return get_job_or_404(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events с прогрессом задачи до её завершения"""
+    job = get_job_or_404(job_id)
+    
+    async def event_stream():
+        async for item in job.stream(heartbeat=config.JOB_SSE_HEARTBEAT):
+            if item is None:
+                yield b": heartbeat\n\n"
+                continue
+            event, data = item
+            yield b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.api_route("/images/{digest}", methods=["GET", "HEAD"])
+async def get_image(digest: str, http_request: Request):
+    """Сохранённое изображение по sha256: ETag, Range, кэширование навсегда"""
+    if not DIGEST_RE.match(digest):
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    return ImageFileResponse(image_store.path(digest), digest, http_request)
+
+@app.api_route("/images/{digest}/{variant}", methods=["GET", "HEAD"])
+async def get_image_variant(digest: str, variant: str, http_request: Request):
+    """Вариант сохранённого изображения: thumb, preview (WebP), webp, avif"""
+    if not DIGEST_RE.match(digest) or derivative_store is None:
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    path = await derivative_store.get(digest, variant)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Вариант изображения недоступен")
+    return ImageFileResponse(path, f"{digest}.{variant}", http_request)
+
 @app.get("/test-unsplash")
 async def test_unsplash(api_key: str):
     """Тестирование Unsplash API ключа"""
     try:
-        unsplash = UnsplashProvider(api_key)
-        test_url = unsplash.search_image("test", "test")
+        unsplash = get_unsplash(api_key, use_cache=False)
+        test_url = await unsplash.search_image("test", "test")
         
         if test_url:
             return {
@@ -335,6 +1215,8 @@ async def test_unsplash(api_key: str):
             "timestamp": datetime.utcnow().isoformat()
         }
 
+startup_report.mark("init")
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
@@ -0,0 +1,80 @@
+"""Prometheus-метрики сервиса"""
+from typing import Callable, Dict, Iterable
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+# Генерация от 10 мс (кэш, демо) до минуты (DALL-E под нагрузкой)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60)
+
+GENERATE_LATENCY = Histogram(
+    "illustraitor_generate_duration_seconds",
+    "Время ответа генерации по режиму и источнику изображения",
+    ["mode", "source"],
+    buckets=LATENCY_BUCKETS
+)
+
+UPSTREAM_LATENCY = Histogram(
+    "illustraitor_upstream_duration_seconds",
+    "Время запросов к внешним API",
+    ["upstream", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+
+FALLBACKS = Counter(
+    "illustraitor_fallbacks_total",
+    "Переходы из режима OpenAI в демо-режим по причине",
+    ["reason"]
+)
+
+GENERATIONS_IN_FLIGHT = Gauge(
+    "illustraitor_generations_in_flight",
+    "Генерации, выполняющиеся прямо сейчас"
+)
+
+
+def fallback_reason(error: BaseException) -> str:
+    """Короткая метка причины по типу исключения"""
+    if getattr(error, "code", None) == "insufficient_quota":
+        return "quota"
+    name = type(error).__name__
+    return {
+        "CircuitOpenError": "circuit_open",
+        "RateLimitExceeded": "rate_limited",
+        "RateLimitError": "rate_limited",
+        "EngineBusyError": "engine_busy",
+        "APITimeoutError": "timeout",
+        "APIConnectionError": "connection",
+        "AuthenticationError": "auth",
+        "BadRequestError": "bad_request",
+    }.get(name, "error")
+
+
+class StatsCollector:
+    """Отдаёт счётчики из stats() компонентов как gauge-метрики при каждом scrape
+
+    sources — имя компонента -> функция, возвращающая плоский dict чисел.
+    """
+
+    def __init__(self, prefix: str, sources: Dict[str, Callable[[], dict]]):
+        self.prefix = prefix
+        self.sources = sources
+
+    def collect(self) -> Iterable[GaugeMetricFamily]:
+        families: Dict[str, GaugeMetricFamily] = {}
+        for component, source in self.sources.items():
+            for field, value in source().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{field}"
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(
+                        name, f"{field} из stats() компонента", labels=["component"]
+                    )
+                family.add_metric([component], value)
+        return families.values()
+
+
+def register_stats(prefix: str, sources: Dict[str, Callable[[], dict]]):
+    REGISTRY.register(StatsCollector(prefix, sources))
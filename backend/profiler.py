@@ -0,0 +1,115 @@
+"""Статистический профайлер выборочных запросов с записью flame-данных на диск
+
+Отдельный поток раз в interval снимает стек потока event loop и считает
+одинаковые стеки. Результат пишется в формате folded stacks
+(flamegraph.pl, speedscope). В event loop одновременно выполняются
+и другие запросы, поэтому профиль показывает всю работу цикла за время
+профилируемого запроса; одновременно профилируется не больше одного.
+"""
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Сэмплирование стека одного потока из фонового потока"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+
+class RequestProfiler:
+    """Профилирует долю sample_rate запросов, пока включён администратором"""
+
+    def __init__(self, out_dir: str, sample_rate: float = 0.0, interval: float = 0.005):
+        self.out_dir = out_dir
+        self.enabled = False
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.profiled = 0
+        self._active = False
+
+    def configure(self, enabled: bool, sample_rate: Optional[float] = None,
+                  interval_ms: Optional[float] = None):
+        self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if interval_ms is not None:
+            self.interval = max(interval_ms, 1.0) / 1000.0
+
+    def _should_profile(self) -> bool:
+        return (self.enabled and not self._active
+                and self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    @asynccontextmanager
+    async def profile(self, request_id: str):
+        if not self._should_profile():
+            yield
+            return
+        self._active = True
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            samples = sampler.stop()
+            self._active = False
+            self.profiled += 1
+            elapsed_ms = (time.perf_counter() - started) * 1000.0
+            path = os.path.join(self.out_dir, f"{request_id}.folded")
+            await asyncio.to_thread(self._write, path, samples)
+            logger.info("Профиль запроса записан в %s", path,
+                        extra={"samples": sum(samples.values()), "elapsed_ms": round(elapsed_ms, 2)})
+
+    @staticmethod
+    def _write(path: str, samples: Counter):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "interval_ms": round(self.interval * 1000.0, 2),
+            "profiled": self.profiled,
+            "out_dir": self.out_dir
+        }
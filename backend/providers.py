@@ -0,0 +1,249 @@
+"""Источники изображений и роутер, выбирающий их по живой задержке и доле ошибок"""
+import logging
+import random
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from engine import GeneratedImage, ImageEngine
+from resilience import OPEN
+from unsplash import UnsplashProvider
+
+logger = logging.getLogger(__name__)
+
+# Режимы ответа: генерация по промпту или подбор готового изображения
+GENERATE = "openai"
+DEMO = "demo"
+
+
+class ProviderJob(NamedTuple):
+    """Всё, что провайдеру нужно знать о запросе"""
+    text: str
+    style: str
+    style_prompt: str
+    prompt: str
+    size: str
+    quality: str
+    api_key: Optional[str]
+    unsplash_key: Optional[str]
+    response_format: str = "url"
+
+
+class ImageProvider:
+    """Источник изображений для роутера
+
+    fetch() возвращает None, если подходящего изображения нет (это не ошибка),
+    и бросает исключение при сбое — роутер учтёт его в доле ошибок.
+    """
+
+    name = "provider"
+    mode = DEMO
+    model: Optional[str] = None
+    # Запасной вариант: его результат не считается найденным изображением
+    fallback = False
+
+    def available(self, job: ProviderJob) -> bool:
+        """Можно ли вообще обслужить запрос (есть ли нужный ключ)"""
+        return True
+
+    def healthy(self) -> bool:
+        """False — провайдер сейчас заведомо откажет (открыт circuit breaker)"""
+        return True
+
+    async def fetch(self, job: ProviderJob) -> Optional[GeneratedImage]:
+        raise NotImplementedError
+
+
+class OpenAIImageProvider(ImageProvider):
+    """Images API OpenAI или любого совместимого бэкенда через ImageEngine
+
+    api_key — серверный ключ бэкенда. OpenAI-ключ пользователя из запроса
+    используется только при request_key=True: стороннему бэкенду его отдавать нельзя.
+    """
+
+    mode = GENERATE
+
+    def __init__(self, name: str, engine: ImageEngine, api_key: Optional[str] = None,
+                 request_key: bool = False):
+        self.name = name
+        self.engine = engine
+        self.model = engine.model
+        self.api_key = api_key or None
+        self.request_key = request_key
+
+    def _key(self, job: ProviderJob) -> Optional[str]:
+        return self.api_key or (job.api_key if self.request_key else None)
+
+    def available(self, job: ProviderJob) -> bool:
+        return bool(self._key(job))
+
+    def healthy(self) -> bool:
+        return self.engine.breaker is None or self.engine.breaker.state != OPEN
+
+    async def fetch(self, job: ProviderJob) -> Optional[GeneratedImage]:
+        return await self.engine.generate(
+            api_key=self._key(job),
+            prompt=job.prompt,
+            size=job.size,
+            quality=job.quality,
+            response_format=job.response_format
+        )
+
+
+class UnsplashImageProvider(ImageProvider):
+    """Поиск готового фото в Unsplash по ключу из запроса"""
+
+    def __init__(self, name: str, client_factory: Callable[[str], UnsplashProvider]):
+        self.name = name
+        self.client_factory = client_factory
+
+    def available(self, job: ProviderJob) -> bool:
+        return bool(job.unsplash_key)
+
+    async def fetch(self, job: ProviderJob) -> Optional[GeneratedImage]:
+        url = await self.client_factory(job.unsplash_key).search_image(job.text, job.style_prompt)
+        return GeneratedImage(url=url, data=None, revised_prompt=None) if url else None
+
+
+class StaticImageProvider(ImageProvider):
+    """Статичное демо-изображение стиля; отвечает всегда"""
+
+    fallback = True
+
+    def __init__(self, name: str, images: Dict[str, str]):
+        self.name = name
+        self.images = images
+
+    async def fetch(self, job: ProviderJob) -> Optional[GeneratedImage]:
+        url = self.images.get(job.style, self.images["default"])
+        return GeneratedImage(url=url, data=None, revised_prompt=None)
+
+
+def parse_policy(spec: str) -> List[List[str]]:
+    """"openai,openai_compat;unsplash;static" -> [["openai", "openai_compat"], ["unsplash"], ["static"]]
+
+    Группы через ";" пробуются по порядку, внутри группы провайдеры
+    взаимозаменяемы и ранжируются по текущим показателям.
+    """
+    groups = []
+    for group in spec.split(";"):
+        names = [name.strip() for name in group.split(",") if name.strip()]
+        if names:
+            groups.append(names)
+    return groups
+
+
+def parse_style_policies(spec: str) -> Dict[str, List[List[str]]]:
+    """"anime=openai_compat,openai;static|vintage@free=static" -> {стиль[@тариф]: политика}"""
+    policies = {}
+    for part in spec.split("|"):
+        target, _, policy = part.partition("=")
+        if target.strip() and policy.strip():
+            policies[target.strip()] = parse_policy(policy)
+    return policies
+
+
+class ProviderHealth:
+    """EWMA задержки и доли ошибок одного провайдера"""
+
+    __slots__ = ("alpha", "latency", "error_rate", "calls", "errors", "misses")
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.misses = 0
+
+    def observe(self, elapsed: float, ok: bool):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+            # Быстрый локальный отказ (очередь, лимит) не должен выглядеть как быстрый ответ
+            elapsed = max(elapsed, self.latency or 0.0)
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.alpha * (elapsed - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def as_dict(self) -> dict:
+        return {
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else 0.0,
+            "error_rate": round(self.error_rate, 4),
+            "calls": self.calls,
+            "errors": self.errors,
+            "misses": self.misses
+        }
+
+
+class ProviderRouter:
+    """Порядок провайдеров для запроса по политике и живым показателям
+
+    Политика выбирается по "стиль@тариф", затем по стилю, затем по тарифу.
+    Внутри группы первым идёт провайдер с наименьшей задержкой с поправкой
+    на ошибки; ещё не опрошенные идут первыми, а с вероятностью
+    explore_rate порядок перемешивается, чтобы оценки не устаревали.
+    """
+
+    def __init__(self, providers: Iterable[ImageProvider], tier_policies: Dict[str, str],
+                 style_policies: str = "", alpha: float = 0.2, error_penalty: float = 4.0,
+                 explore_rate: float = 0.05, rng: Optional[random.Random] = None):
+        self.providers: Dict[str, ImageProvider] = {provider.name: provider for provider in providers}
+        self.tier_policies = {tier: parse_policy(spec) for tier, spec in tier_policies.items()}
+        self.style_policies = parse_style_policies(style_policies)
+        self.error_penalty = error_penalty
+        self.explore_rate = explore_rate
+        self._rng = rng or random.Random()
+        self.health = {name: ProviderHealth(alpha) for name in self.providers}
+
+        for policy in [*self.tier_policies.values(), *self.style_policies.values()]:
+            for name in (name for group in policy for name in group):
+                if name not in self.providers:
+                    logger.warning("Провайдер %s из политики маршрутизации не зарегистрирован", name)
+
+    def policy(self, style: str, tier: str) -> List[List[str]]:
+        return (self.style_policies.get(f"{style}@{tier}")
+                or self.style_policies.get(style)
+                or self.tier_policies.get(tier, []))
+
+    def score(self, provider: ImageProvider) -> float:
+        if not provider.healthy():
+            return float("inf")
+        health = self.health[provider.name]
+        if health.latency is None:
+            return 0.0
+        return health.latency * (1.0 + self.error_penalty * health.error_rate)
+
+    def route(self, job: ProviderJob, tier: str) -> List[ImageProvider]:
+        """Провайдеры в порядке попыток для этого запроса"""
+        ordered = []
+        for group in self.policy(job.style, tier):
+            members = [self.providers[name] for name in group
+                       if name in self.providers and self.providers[name].available(job)]
+            if len(members) > 1 and self._rng.random() < self.explore_rate:
+                self._rng.shuffle(members)
+            else:
+                members.sort(key=self.score)
+            ordered.extend(members)
+        return ordered
+
+    async def call(self, provider: ImageProvider, job: ProviderJob) -> Optional[GeneratedImage]:
+        """fetch() с учётом задержки и исхода в показателях провайдера"""
+        health = self.health[provider.name]
+        started = time.perf_counter()
+        try:
+            image = await provider.fetch(job)
+        except Exception:
+            health.observe(time.perf_counter() - started, ok=False)
+            raise
+        health.observe(time.perf_counter() - started, ok=True)
+        if image is None:
+            health.misses += 1
+        return image
+
+    def stats(self) -> dict:
+        return {
+            name: dict(self.health[name].as_dict(), mode=provider.mode, healthy=provider.healthy())
+            for name, provider in self.providers.items()
+        }
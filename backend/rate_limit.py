@@ -0,0 +1,170 @@
+"""Лимит запросов к апстриму по ключу с учётом Retry-After и заголовков x-ratelimit-*"""
+import asyncio
+import logging
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional, Tuple
+
+from cache import LRUTTLCache
+from state import MemoryStateBackend, StateBackend, StateBackendError
+
+logger = logging.getLogger(__name__)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimitExceeded(Exception):
+    """Токен не освободится в пределах допустимого ожидания"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Длительность из заголовков OpenAI: "1s", "6m0s", "20ms" или число секунд"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNIT_SECONDS[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """Через сколько секунд апстрим просит повторить запрос"""
+    retry_ms = headers.get("retry-after-ms")
+    if retry_ms:
+        try:
+            return max(float(retry_ms) / 1000.0, 0.0)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                moment = parsedate_to_datetime(retry_after)
+                return max(moment.timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return parse_duration(headers.get("x-ratelimit-reset-requests"))
+
+
+class UpstreamRateLimiter:
+    """Сглаживает всплески запросов к апстриму вместо мгновенного отказа
+
+    Запросы встают в очередь, если слот освободится в пределах
+    wait_budget; иначе сразу получают RateLimitExceeded. Лимит
+    и окна сброса подстраиваются по ответным заголовкам апстрима.
+    Слоты хранятся в StateBackend, поэтому с общим хранилищем лимит
+    один на все воркеры; при его недоступности запросы пропускаются.
+    """
+
+    def __init__(self, per_minute: float, wait_budget: float,
+                 max_keys: int = 10000, idle_ttl: float = 600.0,
+                 state: Optional[StateBackend] = None, namespace: str = "openai"):
+        self.per_minute = per_minute
+        self.wait_budget = wait_budget
+        self.namespace = namespace
+        self.state = state or MemoryStateBackend(max_size=max_keys, ttl=idle_ttl)
+        # Лимит, который апстрим сообщил для ключа в x-ratelimit-limit-requests
+        self._limits = LRUTTLCache(max_size=max_keys, ttl=idle_ttl, sliding=True)
+        self.queued = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def _slot(self, key: str) -> Tuple[str, float, float]:
+        """(ключ в хранилище, интервал между запросами, допуск всплеска)"""
+        capacity = self._limits.get(key) or self.per_minute
+        interval = 60.0 / capacity
+        return f"rl:{self.namespace}:{key}", interval, (capacity - 1.0) * interval
+
+    async def acquire(self, key: str, max_wait: Optional[float] = None) -> float:
+        """Ждёт свой слот и возвращает время ожидания в секундах"""
+        budget = self.wait_budget if max_wait is None else min(max_wait, self.wait_budget)
+        slot, interval, tolerance = self._slot(key)
+        try:
+            allowed, wait = await self.state.reserve(slot, interval, tolerance, max(budget, 0.0))
+        except StateBackendError as e:
+            self.errors += 1
+            logger.warning("Лимитер без хранилища, запрос пропущен: %s", e)
+            return 0.0
+        if not allowed:
+            self.rejected += 1
+            raise RateLimitExceeded(
+                f"Лимит запросов апстрима: свободный слот через {wait:.1f} с", wait
+            )
+        if wait > 0:
+            self.queued += 1
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Освобождаем зарезервированный слот для следующих в очереди
+                await self._refund(slot, interval)
+                raise
+        return wait
+
+    async def _refund(self, slot: str, interval: float):
+        try:
+            await self.state.refund(slot, interval)
+        except StateBackendError:
+            self.errors += 1
+
+    async def _defer(self, key: str, delay: float):
+        slot, _, tolerance = self._slot(key)
+        try:
+            await self.state.defer(slot, delay, tolerance)
+        except StateBackendError as e:
+            self.errors += 1
+            logger.warning("Лимитер не смог сохранить паузу: %s", e)
+
+    async def penalize(self, key: str, delay: float):
+        """Апстрим ответил 429: никого не пускать раньше, чем через delay секунд"""
+        self.throttled += 1
+        await self._defer(key, delay)
+
+    async def observe_headers(self, key: str, headers: Mapping[str, str]):
+        """Подстраивает лимит под x-ratelimit-* заголовки ответа"""
+        limit = headers.get("x-ratelimit-limit-requests")
+        if limit:
+            try:
+                limit_value = float(limit)
+            except ValueError:
+                limit_value = 0.0
+            if limit_value > 0:
+                self._limits.set(key, limit_value)
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is not None:
+            try:
+                remaining_value = float(remaining)
+            except ValueError:
+                return
+            _, interval, tolerance = self._slot(key)
+            if remaining_value <= 0:
+                reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+                await self._defer(key, reset or interval)
+            elif (remaining_value - 1.0) * interval < tolerance:
+                # Свободных слотов не больше, чем сообщил апстрим
+                await self._defer(key, -(remaining_value - 1.0) * interval)
+
+    def stats(self) -> dict:
+        return {
+            "per_minute": self.per_minute,
+            "wait_budget": self.wait_budget,
+            "keys": len(self._limits),
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "state": self.state.name
+        }
@@ -0,0 +1,135 @@
+"""Circuit breaker и политика повторов для вызовов апстрима"""
+import random
+import sys
+import time
+from typing import Callable, Tuple, Type
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Апстрим признан недоступным, вызов не выполняется"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' открыт, повтор через {retry_after:.1f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def transient_errors() -> Tuple[Type[BaseException], ...]:
+    """Ошибки, после которых повтор имеет смысл и которые говорят о здоровье апстрима
+
+    Берутся только из уже загруженных клиентов: исключение незагруженной
+    библиотеки возникнуть не могло, а импортировать её ради проверки незачем.
+    """
+    errors = []
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        errors += [openai.APIConnectionError, openai.InternalServerError]  # включает APITimeoutError
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        errors.append(httpx.TransportError)
+    return tuple(errors)
+
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, transient_errors()):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+class CircuitBreaker:
+    """Автомат closed → open → half-open для одного апстрима
+
+    После failure_threshold транзиентных ошибок подряд вызовы отклоняются
+    без сетевого запроса на recovery_timeout секунд; затем пропускается
+    half_open_max_calls пробных вызовов, и успех снова замыкает цепь.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float,
+                 half_open_max_calls: int = 1, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+            self._state = HALF_OPEN
+            self._trial_calls = 0
+        return self._state
+
+    def before_call(self):
+        """Бросает CircuitOpenError, если вызов сейчас делать нельзя"""
+        state = self.state
+        if state == OPEN:
+            self.rejected += 1
+            retry_after = self.recovery_timeout - (self._clock() - self._opened_at)
+            raise CircuitOpenError(self.name, max(retry_after, 0.0))
+        if state == HALF_OPEN:
+            if self._trial_calls >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.recovery_timeout)
+            self._trial_calls += 1
+
+    def record_cancelled(self):
+        """Пробный вызов прерван без ответа: освобождаем его слот"""
+        if self._state == HALF_OPEN and self._trial_calls > 0:
+            self._trial_calls -= 1
+
+    def record_success(self):
+        self._failures = 0
+        self._state = CLOSED
+
+    def record_failure(self):
+        if self._state == HALF_OPEN:
+            self._open()
+            return
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._failures = 0
+        self.opened += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected
+        }
+
+
+class RetryPolicy:
+    """Повторы только для транзиентных ошибок с экспоненциальной задержкой и full jitter"""
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float,
+                 rng: Callable[[], float] = random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = rng
+        self.retries = 0
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        """attempt — номер только что неудавшейся попытки, начиная с 1"""
+        return attempt < self.max_attempts and is_transient(error)
+
+    def backoff(self, attempt: int) -> float:
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return ceiling * self._rng()
@@ -0,0 +1,77 @@
+"""Кэш результатов генерации OpenAI"""
+import hashlib
+import logging
+import re
+from typing import Optional
+
+import orjson
+
+from state import MemoryStateBackend, StateBackend, StateBackendError
+
+logger = logging.getLogger(__name__)
+
+_PUNCT_EDGES = re.compile(r"^[\s\W_]+|[\s\W_]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Приводит текст запроса к каноническому виду для ключа кэша"""
+    text = _SPACES.sub(" ", text.strip().lower())
+    return _PUNCT_EDGES.sub("", text)
+
+
+def result_key(style_prompt: str, text: str, size: str, quality: str) -> str:
+    raw = "\x1f".join((style_prompt, normalize_prompt(text), size, quality))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Ответы /generate в режиме OpenAI по (стиль, нормализованный текст, размер, качество)
+
+    Ошибки общего хранилища не ломают генерацию: чтение считается промахом.
+    """
+
+    def __init__(self, enabled: bool, max_size: int, ttl: float,
+                 state: Optional[StateBackend] = None):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.state = state or MemoryStateBackend(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        try:
+            raw = await self.state.get(f"result:{key}")
+        except StateBackendError as e:
+            self.errors += 1
+            logger.warning("Кэш результатов недоступен: %s", e)
+            return None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return orjson.loads(raw)
+
+    async def put(self, key: str, result: dict):
+        if not self.enabled:
+            return
+        try:
+            await self.state.set(f"result:{key}", orjson.dumps(result), ttl=self.ttl)
+        except StateBackendError as e:
+            self.errors += 1
+            logger.warning("Кэш результатов недоступен: %s", e)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(
+            self.state.stats(),
+            enabled=self.enabled,
+            ttl=self.ttl,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=round(self.hits / lookups, 4) if lookups else 0.0,
+            errors=self.errors
+        )
@@ -0,0 +1,184 @@
+"""Поиск почти одинаковых промптов: MinHash-подписи и LSH-корзины по стилю, размеру и качеству
+
+Промпты, отличающиеся пунктуацией, порядком слов или словами-паразитами,
+дают близкие наборы шинглов; MinHash оценивает их сходство по Жаккару,
+а LSH находит кандидатов без перебора всего индекса. Итоговое сходство
+кандидата считается точно по его шинглам.
+"""
+import asyncio
+import random
+import re
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# Модуль для универсального хеширования (простое число Мерсенна 2^31 - 1):
+# произведения помещаются в 64 бита, что заметно быстрее длинной арифметики
+MERSENNE_PRIME = (1 << 31) - 1
+
+# Слова, не меняющие смысла запроса на картинку
+# Изображение подходит только к запросу того же стиля, размера и качества
+Scope = Tuple[str, str, str]
+
+FILLER_WORDS = frozenset("""
+a an the of and or with in on at for to please simple image picture photo illustration draw drawing
+и в во на с со для по из к пожалуйста картинка изображение рисунок иллюстрация нарисуй нарисовать
+""".split())
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """Слова без паразитов и их символьные триграммы; порядок слов не важен"""
+    words = {word for word in re.findall(r"\w+", text.lower()) if word not in FILLER_WORDS}
+    result: Set[str] = set()
+    for word in words:
+        result.add("w:" + word)
+        padded = f"^{word}$"
+        result.update("c:" + padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(result)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarPrompt(NamedTuple):
+    text: str
+    image_url: str
+    similarity: float
+
+
+class _Entry(NamedTuple):
+    id: int
+    scope: Scope
+    text: str
+    image_url: str
+    shingles: FrozenSet[str]
+    keys: Tuple[Tuple[int, ...], ...]
+
+
+class _Tables:
+    """Записи и LSH-корзины; пересобранные таблицы подменяют старые целиком"""
+
+    def __init__(self, bands: int):
+        self.entries: Dict[int, _Entry] = {}
+        self.order: deque = deque()
+        # (стиль, размер, качество) -> номер полосы -> ключ полосы -> id записей
+        self.buckets: Dict[Scope, List[Dict[Tuple[int, ...], Set[int]]]] = {}
+        # (стиль, размер, качество) -> набор шинглов -> id: точные повторы не занимают место
+        self.exact: Dict[Scope, Dict[FrozenSet[str], int]] = {}
+        self.bands = bands
+        self.next_id = 0
+
+
+class SimilarityIndex:
+    """Индекс прошлых промптов по (стиль, размер, качество) с порогом сходства threshold
+
+    num_perm = bands * rows; вероятность, что пара со сходством s попадёт
+    в общую корзину, равна 1 - (1 - s^rows)^bands (при 16 x 4 — около 0.5 для s = 0.5
+    и больше 0.99 для s = 0.8).
+    """
+
+    def __init__(self, threshold: float = 0.8, bands: int = 16, rows: int = 4,
+                 max_entries: int = 10000, seed: int = 1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.max_entries = max_entries
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(bands * rows)
+        ]
+        self._tables = _Tables(bands)
+        self.lookups = 0
+        self.hits = 0
+        self.candidates = 0
+        self.rebuilds = 0
+
+    def _band_keys(self, items: FrozenSet[str]) -> Tuple[Tuple[int, ...], ...]:
+        # Индекс живёт в памяти процесса, поэтому годится встроенный hash() строк
+        hashes = [hash(item) % MERSENNE_PRIME for item in items]
+        signature = [min([(a * h + b) % MERSENNE_PRIME for h in hashes]) for a, b in self._perms]
+        return tuple(
+            tuple(signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)
+        )
+
+    def _insert(self, tables: _Tables, scope: Scope, text: str, image_url: str):
+        items = shingles(text)
+        if not items:
+            return
+        exact = tables.exact.setdefault(scope, {})
+        if items in exact:
+            # Тот же промпт с точностью до паразитов — храним последнее изображение
+            entry = tables.entries[exact[items]]
+            tables.entries[entry.id] = entry._replace(text=text, image_url=image_url)
+            return
+        keys = self._band_keys(items)
+        entry = _Entry(tables.next_id, scope, text, image_url, items, keys)
+        tables.next_id += 1
+        tables.entries[entry.id] = entry
+        tables.order.append(entry.id)
+        exact[items] = entry.id
+        buckets = tables.buckets.setdefault(scope, [{} for _ in range(self.bands)])
+        for band, key in zip(buckets, keys):
+            band.setdefault(key, set()).add(entry.id)
+        while len(tables.entries) > self.max_entries:
+            self._evict(tables, tables.order.popleft())
+
+    def _evict(self, tables: _Tables, entry_id: int):
+        entry = tables.entries.pop(entry_id)
+        tables.exact[entry.scope].pop(entry.shingles, None)
+        for band, key in zip(tables.buckets[entry.scope], entry.keys):
+            members = band.get(key)
+            if members is not None:
+                members.discard(entry_id)
+                if not members:
+                    del band[key]
+
+    def add(self, style: str, size: str, quality: str, text: str, image_url: str):
+        self._insert(self._tables, (style, size, quality), text, image_url)
+
+    def lookup(self, style: str, size: str, quality: str, text: str) -> Optional[SimilarPrompt]:
+        """Самый похожий прошлый промпт того же стиля, размера и качества не ниже порога"""
+        self.lookups += 1
+        buckets = self._tables.buckets.get((style, size, quality))
+        items = shingles(text)
+        if not buckets or not items:
+            return None
+        found: Set[int] = set()
+        for band, key in zip(buckets, self._band_keys(items)):
+            found.update(band.get(key, ()))
+        self.candidates += len(found)
+        best = None
+        for entry_id in found:
+            entry = self._tables.entries[entry_id]
+            similarity = jaccard(items, entry.shingles)
+            if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                best = SimilarPrompt(entry.text, entry.image_url, round(similarity, 3))
+        if best is not None:
+            self.hits += 1
+        return best
+
+    def build(self, rows: Iterable[Tuple[str, str, str, str, str]]) -> _Tables:
+        """Новые таблицы из (style, size, quality, text, image_url) от старых к новым; можно звать из потока"""
+        tables = _Tables(self.bands)
+        for style, size, quality, text, image_url in rows:
+            self._insert(tables, (style, size, quality), text, image_url)
+        return tables
+
+    async def rebuild(self, rows: List[Tuple[str, str, str, str, str]]):
+        """Пересчитывает подписи в потоке и подменяет индекс целиком"""
+        self._tables = await asyncio.to_thread(self.build, rows)
+        self.rebuilds += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._tables.entries),
+            "scopes": len(self._tables.buckets),
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "candidates": self.candidates,
+            "rebuilds": self.rebuilds
+        }
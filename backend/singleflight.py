@@ -0,0 +1,127 @@
+"""Объединение одинаковых одновременных вызовов в один (single-flight)"""
+import asyncio
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import orjson
+
+from state import StateBackend, StateBackendError
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Пока вызов по ключу выполняется, повторные запросы ждут его результата
+
+    Общий вызов защищён от отмены: если первый клиент отключится,
+    остальные всё равно получат результат.
+
+    С общим хранилищем объединение работает и между процессами: первый
+    взявший аренду ключа выполняет вызов и публикует результат (он должен
+    сериализоваться в JSON), остальные опрашивают хранилище, пока аренда жива.
+    Результат привязан к токену аренды и живёт пару интервалов опроса: его
+    получают только ждавшие этот вызов, а не запросы, пришедшие после него.
+    """
+
+    def __init__(self, state: Optional[StateBackend] = None, lease_ttl: float = 120.0,
+                 result_ttl: float = 0.5, poll_interval: float = 0.25):
+        self.state = state
+        self.lease_ttl = lease_ttl
+        # Короче двух интервалов нельзя: ждущий между опросами не успел бы его прочитать
+        self.result_ttl = max(result_ttl, poll_interval * 2)
+        self.poll_interval = poll_interval
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.saved = 0
+        self.remote_saved = 0
+
+    async def do(self, key: str,
+                 fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Возвращает (результат, был_ли_вызов_общим)"""
+        call = self._calls.get(key)
+        if call is not None:
+            self.saved += 1
+            result, _ = await asyncio.shield(call)
+            return result, True
+
+        self.calls += 1
+        call = asyncio.ensure_future(self._run(key, fn))
+        self._calls[key] = call
+
+        def _forget(done: asyncio.Future):
+            if self._calls.get(key) is done:
+                del self._calls[key]
+            if not done.cancelled():
+                # Помечаем исключение полученным, даже если ждать было некому
+                done.exception()
+
+        call.add_done_callback(_forget)
+        return await asyncio.shield(call)
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        if self.state is None:
+            return await fn(), False
+
+        lease = f"flight:{key}"
+        token = uuid.uuid4().hex.encode()
+        try:
+            owner = await self.state.add(lease, token, ttl=self.lease_ttl)
+            if not owner:
+                result = await self._wait_remote(lease)
+                if result is not None:
+                    self.remote_saved += 1
+                    return result, True
+        except StateBackendError as e:
+            logger.warning("Объединение между процессами недоступно: %s", e)
+            return await fn(), False
+
+        try:
+            result = await fn()
+        except BaseException:
+            # Ждущие в других процессах перестанут ждать и выполнят вызов сами
+            if owner:
+                await self._forget_remote(lease)
+            raise
+        if not owner:
+            return result, False
+        try:
+            await self.state.set(f"{lease}:result:{token.decode()}", orjson.dumps(result),
+                                 ttl=self.result_ttl)
+        except (StateBackendError, TypeError) as e:
+            logger.warning("Результат не опубликован для других процессов: %s", e)
+        await self._forget_remote(lease)
+        return result, False
+
+    async def _wait_remote(self, lease: str) -> Any:
+        """Результат вызова, чью аренду застал этот запрос, или None, если его не будет"""
+        token = await self.state.get(lease)
+        if token is None:
+            return None
+        result_key = f"{lease}:result:{token.decode()}"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lease_ttl
+        while loop.time() < deadline:
+            raw = await self.state.get(result_key)
+            if raw is not None:
+                return orjson.loads(raw)
+            if await self.state.get(lease) != token:
+                # Аренда снята: результат мог появиться между двумя чтениями
+                raw = await self.state.get(result_key)
+                return orjson.loads(raw) if raw is not None else None
+            await asyncio.sleep(self.poll_interval)
+        return None
+
+    async def _forget_remote(self, lease: str):
+        try:
+            await self.state.delete(lease)
+        except StateBackendError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "saved": self.saved,
+            "remote_saved": self.remote_saved
+        }
@@ -0,0 +1,95 @@
+"""Учёт времени старта и ленивый импорт тяжёлых клиентских библиотек
+
+Модуль импортируется первым в main.py: отсчёт начинается с него.
+"""
+import asyncio
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Dict, Iterator, Optional
+
+
+def _process_age() -> Optional[float]:
+    """Сколько секунд назад запущен процесс (Linux), до импорта main"""
+    try:
+        with open("/proc/self/stat") as f:
+            # Имя процесса в скобках может содержать пробелы — режем после него
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupReport:
+    """Длительности фаз старта в миллисекундах
+
+    mark() закрывает фазу, начатую предыдущим mark() (или импортом модуля),
+    phase() измеряет вложенный блок, lazy_import() — первую загрузку модуля.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last_mark = self.started
+        self.before_main = _process_age()
+        self.phases: Dict[str, float] = {}
+        self.imports: Dict[str, float] = {}
+        self.ready_ms: Optional[float] = None
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases[name] = round((now - self._last_mark) * 1000, 1)
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    def ready(self):
+        """Сервис прогрет: всё, что откладывалось, загружено"""
+        self.ready_ms = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def as_dict(self) -> dict:
+        report = {f"{name}_ms": value for name, value in self.phases.items()}
+        report.update({f"import_{name}_ms": value for name, value in self.imports.items()})
+        if self.before_main is not None:
+            report["before_main_ms"] = round(self.before_main * 1000, 1)
+        if self.ready_ms is not None:
+            report["ready_ms"] = self.ready_ms
+        return report
+
+
+startup_report = StartupReport()
+
+
+# Модули, импорт которых полностью завершён через lazy_import()
+_loaded = set()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Импортирует модуль при первом обращении и записывает, сколько это заняло"""
+    if name in sys.modules:
+        # import_module дождётся, если модуль ещё грузится в потоке прогрева
+        module = importlib.import_module(name)
+    else:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        startup_report.imports.setdefault(name, round((time.perf_counter() - started) * 1000, 1))
+    _loaded.add(name)
+    return module
+
+
+async def lazy_import_async(name: str) -> ModuleType:
+    """lazy_import() для корутин: первая загрузка (или ожидание прогрева) идёт в потоке,
+    не останавливая цикл событий"""
+    if name in _loaded:
+        return sys.modules[name]
+    return await asyncio.to_thread(lazy_import, name)
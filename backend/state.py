@@ -0,0 +1,502 @@
+"""Хранилище общего состояния: кэши, dedup и счётчики лимитов
+
+Пока сервис работает одним процессом, достаточно памяти процесса.
+С несколькими воркерами или инстансами состояние выносится в общий
+SQLite-файл (одна машина) или Redis-совместимый сервер:
+
+    STATE_BACKEND=memory
+    STATE_BACKEND=sqlite:///state.db          # sqlite:////abs/path.db — абсолютный путь
+    STATE_BACKEND=redis://:password@localhost:6379/0
+"""
+import asyncio
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackendError(Exception):
+    """Хранилище недоступно или ответило ошибкой"""
+
+
+def gcra(tat: Optional[float], now: float, interval: float, tolerance: float,
+         max_wait: float) -> Tuple[bool, float, float]:
+    """Шаг GCRA — token bucket, сжатый до одного числа (theoretical arrival time)
+
+    Возвращает (допущен, ожидание, новое tat). Ведро ёмкостью capacity
+    с пополнением раз в interval соответствует tolerance = (capacity - 1) * interval.
+    """
+    tat = max(tat if tat is not None else now, now)
+    wait = max(tat - tolerance - now, 0.0)
+    if wait > max_wait:
+        return False, wait, tat
+    return True, wait, tat + interval
+
+
+class StateBackend:
+    """Атомарные операции над общим состоянием; значения — байты"""
+
+    name = "state"
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.ops = 0
+        self.errors = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """Записывает, только если ключа нет; True — запись наша"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        """Атомарный счётчик; ttl задаётся при создании ключа"""
+        raise NotImplementedError
+
+    async def reserve(self, key: str, interval: float, tolerance: float,
+                      max_wait: float) -> Tuple[bool, float]:
+        """Резервирует слот лимита (см. gcra): (допущен, ожидание в секундах)"""
+        raise NotImplementedError
+
+    async def defer(self, key: str, delay: float, tolerance: float):
+        """Следующий слот лимита — не раньше чем через delay секунд"""
+        raise NotImplementedError
+
+    async def refund(self, key: str, interval: float):
+        """Возвращает неиспользованный слот"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "ops": self.ops, "errors": self.errors}
+
+
+class MemoryStateBackend(StateBackend):
+    """Состояние в памяти процесса: прежнее поведение для одного воркера"""
+
+    name = "memory"
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0, prefix: str = "",
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(prefix)
+        self._clock = clock
+        self._data = LRUTTLCache(max_size=max_size, ttl=ttl, clock=clock)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        self.ops += 1
+        return self._data.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self.ops += 1
+        self._data.set(self.prefix + key, value, ttl=ttl)
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        self.ops += 1
+        if self.prefix + key in self._data:
+            return False
+        self._data.set(self.prefix + key, value, ttl=ttl)
+        return True
+
+    async def delete(self, key: str):
+        self.ops += 1
+        self._data.pop(self.prefix + key)
+
+    async def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        self.ops += 1
+        entry = self._data.get(self.prefix + key)
+        if entry is None:
+            entry = [0]
+            self._data.set(self.prefix + key, entry, ttl=ttl)
+        entry[0] += 1
+        return entry[0]
+
+    async def reserve(self, key: str, interval: float, tolerance: float,
+                      max_wait: float) -> Tuple[bool, float]:
+        self.ops += 1
+        now = self._clock()
+        allowed, wait, tat = gcra(self._data.get(self.prefix + key), now, interval, tolerance, max_wait)
+        if allowed:
+            self._data.set(self.prefix + key, tat, ttl=tat - now + tolerance + 1.0)
+        return allowed, wait
+
+    async def defer(self, key: str, delay: float, tolerance: float):
+        self.ops += 1
+        now = self._clock()
+        target = now + delay + tolerance
+        tat = self._data.get(self.prefix + key)
+        if tat is None or tat < target:
+            self._data.set(self.prefix + key, target, ttl=delay + tolerance + 1.0)
+
+    async def refund(self, key: str, interval: float):
+        self.ops += 1
+        tat = self._data.get(self.prefix + key)
+        if tat is not None:
+            self._data.set(self.prefix + key, tat - interval, ttl=max(tat - self._clock(), 0.0) + 1.0)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["keys"] = len(self._data)
+        return stats
+
+
+class SQLiteStateBackend(StateBackend):
+    """Общий SQLite-файл в режиме WAL для воркеров на одной машине
+
+    Запросы выполняются в пуле потоков; атомарность между процессами
+    даёт BEGIN IMMEDIATE. Время — системное, общее для всех процессов.
+    """
+
+    name = "sqlite"
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, prefix: str = "", clock: Callable[[], float] = time.time):
+        super().__init__(prefix)
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " key TEXT PRIMARY KEY, value BLOB, expires_at REAL)"
+        )
+
+    async def _run(self, fn: Callable, *args):
+        self.ops += 1
+        try:
+            return await asyncio.to_thread(self._locked, fn, *args)
+        except sqlite3.Error as e:
+            self.errors += 1
+            raise StateBackendError(f"SQLite: {e}") from e
+
+    def _locked(self, fn: Callable, *args):
+        with self._lock:
+            return fn(*args)
+
+    def _expires(self, now: float, ttl: Optional[float]) -> Optional[float]:
+        return now + ttl if ttl is not None else None
+
+    def _read(self, key: str, now: float):
+        row = self._conn.execute(
+            "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _write(self, key: str, value, expires_at: Optional[float]):
+        self._conn.execute(
+            "INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, value, expires_at)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._conn.execute("DELETE FROM state WHERE expires_at <= ?", (self._clock(),))
+
+    def _transaction(self, fn: Callable, *args):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return result
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run(lambda: self._read(self.prefix + key, self._clock()))
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self._run(lambda: self._write(self.prefix + key, value, self._expires(self._clock(), ttl)))
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        def add():
+            now = self._clock()
+            if self._read(self.prefix + key, now) is not None:
+                return False
+            self._write(self.prefix + key, value, self._expires(now, ttl))
+            return True
+        return await self._run(self._transaction, add)
+
+    async def delete(self, key: str):
+        await self._run(lambda: self._conn.execute("DELETE FROM state WHERE key = ?", (self.prefix + key,)))
+
+    async def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        def incr():
+            now = self._clock()
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (self.prefix + key, now)
+            ).fetchone()
+            if row is None:
+                self._write(self.prefix + key, 1, self._expires(now, ttl))
+                return 1
+            self._write(self.prefix + key, int(row[0]) + 1, row[1])
+            return int(row[0]) + 1
+        return await self._run(self._transaction, incr)
+
+    async def reserve(self, key: str, interval: float, tolerance: float,
+                      max_wait: float) -> Tuple[bool, float]:
+        def reserve():
+            now = self._clock()
+            stored = self._read(self.prefix + key, now)
+            allowed, wait, tat = gcra(
+                float(stored) if stored is not None else None, now, interval, tolerance, max_wait
+            )
+            if allowed:
+                self._write(self.prefix + key, tat, tat + tolerance + 1.0)
+            return allowed, wait
+        return await self._run(self._transaction, reserve)
+
+    async def defer(self, key: str, delay: float, tolerance: float):
+        def defer():
+            now = self._clock()
+            target = now + delay + tolerance
+            stored = self._read(self.prefix + key, now)
+            if stored is None or float(stored) < target:
+                self._write(self.prefix + key, target, target + 1.0)
+        await self._run(self._transaction, defer)
+
+    async def refund(self, key: str, interval: float):
+        def refund():
+            now = self._clock()
+            stored = self._read(self.prefix + key, now)
+            if stored is not None:
+                self._write(self.prefix + key, float(stored) - interval, float(stored) + 1.0)
+        await self._run(self._transaction, refund)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Операции лимита выполняются на сервере одним скриптом, чтобы быть атомарными.
+# Числа возвращаются строками: Lua-числа Redis округляет до целых
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local wait = tat - tolerance - now
+if wait < 0 then wait = 0 end
+if wait > max_wait then return {0, tostring(wait)} end
+tat = tat + interval
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now + tolerance) * 1000) + 1000)
+return {1, tostring(wait)}
+"""
+
+_DEFER_SCRIPT = """
+local now = tonumber(ARGV[1])
+local target = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or 0)
+if target > tat then
+  redis.call('SET', KEYS[1], ARGV[2], 'PX', math.ceil((target - now) * 1000) + 1000)
+end
+return 1
+"""
+
+_REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('INCRBYFLOAT', KEYS[1], '-' .. ARGV[1])
+end
+return 1
+"""
+
+
+class RespConnection:
+    """Одно соединение по протоколу Redis (RESP2)"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    def encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, bytes):
+                arg = repr(arg).encode("ascii") if isinstance(arg, float) else str(arg).encode("ascii")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def execute(self, *args):
+        self.writer.write(self.encode(args))
+        await self.writer.drain()
+        return await self.read_reply()
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise StateBackendError(payload.decode(errors="replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count < 0:
+                return None
+            return [await self.read_reply() for _ in range(count)]
+        raise StateBackendError(f"Неизвестный ответ Redis: {line[:50]!r}")
+
+    def close(self):
+        self.writer.close()
+
+
+class RedisStateBackend(StateBackend):
+    """Redis-совместимый сервер (Redis, Valkey, KeyDB) без внешних зависимостей"""
+
+    name = "redis"
+
+    def __init__(self, url: str, pool_size: int = 10, timeout: float = 2.0, prefix: str = "",
+                 clock: Callable[[], float] = time.time):
+        super().__init__(prefix)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._clock = clock
+        self._pool: asyncio.Queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(pool_size)
+        self._scripts = {}
+
+    async def _connect(self) -> RespConnection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        conn = RespConnection(reader, writer)
+        try:
+            if self.password:
+                auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+                await conn.execute(*auth)
+            if self.db:
+                await conn.execute("SELECT", self.db)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def execute(self, *args):
+        self.ops += 1
+        async with self._slots:
+            conn = None if self._pool.empty() else self._pool.get_nowait()
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(self._connect(), timeout=self.timeout)
+                reply = await asyncio.wait_for(conn.execute(*args), timeout=self.timeout)
+            except StateBackendError:
+                # Ошибка команды: само соединение исправно
+                self.errors += 1
+                if conn is not None:
+                    self._pool.put_nowait(conn)
+                raise
+            except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                # Состояние соединения неизвестно — закрываем, следующий вызов откроет новое
+                self.errors += 1
+                if conn is not None:
+                    conn.close()
+                raise StateBackendError(f"Redis {self.host}:{self.port}: {e!r}") from e
+            except BaseException:
+                if conn is not None:
+                    conn.close()
+                raise
+            self._pool.put_nowait(conn)
+            return reply
+
+    async def _eval(self, script: str, key: str, *args) -> List:
+        sha = self._scripts.get(script)
+        if sha is not None:
+            try:
+                return await self.execute("EVALSHA", sha, 1, key, *args)
+            except StateBackendError as e:
+                if "NOSCRIPT" not in str(e):
+                    raise
+        self._scripts[script] = (await self.execute("SCRIPT", "LOAD", script)).decode()
+        return await self.execute("EVALSHA", self._scripts[script], 1, key, *args)
+
+    @staticmethod
+    def _ttl_args(ttl: Optional[float]) -> Tuple:
+        return ("PX", max(int(math.ceil(ttl * 1000)), 1)) if ttl is not None else ()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self.execute("SET", self.prefix + key, value, *self._ttl_args(ttl))
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        return await self.execute("SET", self.prefix + key, value, "NX", *self._ttl_args(ttl)) == "OK"
+
+    async def delete(self, key: str):
+        await self.execute("DEL", self.prefix + key)
+
+    async def incr(self, key: str, ttl: Optional[float] = None) -> int:
+        value = await self.execute("INCR", self.prefix + key)
+        if value == 1 and ttl is not None:
+            await self.execute("PEXPIRE", self.prefix + key, max(int(math.ceil(ttl * 1000)), 1))
+        return value
+
+    async def reserve(self, key: str, interval: float, tolerance: float,
+                      max_wait: float) -> Tuple[bool, float]:
+        allowed, wait = await self._eval(
+            _RESERVE_SCRIPT, self.prefix + key, self._clock(), interval, tolerance, max_wait
+        )
+        return allowed == 1, float(wait)
+
+    async def defer(self, key: str, delay: float, tolerance: float):
+        now = self._clock()
+        await self._eval(_DEFER_SCRIPT, self.prefix + key, now, now + delay + tolerance)
+
+    async def refund(self, key: str, interval: float):
+        await self._eval(_REFUND_SCRIPT, self.prefix + key, interval)
+
+    async def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def create_state_backend(url: str, prefix: str = "") -> Optional[StateBackend]:
+    """Общее хранилище по STATE_BACKEND; None — каждый компонент держит состояние в памяти"""
+    url = (url or "memory").strip()
+    if url == "memory":
+        return None
+    if url.startswith("sqlite:"):
+        path = url[len("sqlite:"):]
+        if path.startswith("///"):
+            path = path[3:]
+        return SQLiteStateBackend(path or "state.db", prefix=prefix)
+    if url.startswith("redis://"):
+        return RedisStateBackend(url, prefix=prefix)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {url}")
@@ -0,0 +1,54 @@
+"""Замеры этапов запроса и заголовок Server-Timing"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+
+class Timings:
+    """Список этапов запроса с длительностью в миллисекундах"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+
+    def add(self, name: str, duration_ms: float):
+        self.spans.append((name, duration_ms))
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000.0
+
+    def as_dict(self) -> dict:
+        result: dict = {}
+        for name, duration in self.spans:
+            # Повторяющиеся этапы (ретраи) суммируются
+            result[name] = round(result.get(name, 0.0) + duration, 2)
+        result["total"] = round(self.total_ms(), 2)
+        return result
+
+    def header(self) -> str:
+        """Значение заголовка Server-Timing"""
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.as_dict().items())
+
+
+current_timings: ContextVar[Optional[Timings]] = ContextVar("current_timings", default=None)
+
+
+def start_timings() -> Timings:
+    timings = Timings()
+    current_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(name: str):
+    """Замер этапа; вне запроса с Timings ничего не делает"""
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, (time.perf_counter() - started) * 1000.0)
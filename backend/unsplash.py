@@ -0,0 +1,136 @@
+"""Асинхронный поиск изображений через Unsplash API"""
+import logging
+import time
+from typing import TYPE_CHECKING, List, Optional
+
+import orjson
+
+from metrics import UPSTREAM_LATENCY
+from state import MemoryStateBackend, StateBackend
+from timing import span
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+_MISS = object()
+
+
+class SearchResultCache:
+    """Кэш результатов поиска: страница кандидатов выдаётся по кругу
+
+    Пустые ответы тоже кэшируются (на negative_ttl), чтобы не тратить
+    квоту демо-ключа на заведомо пустые запросы. Курсор хранится рядом
+    со страницей, так что с общим хранилищем круг один на все воркеры.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float,
+                 state: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.state = state or MemoryStateBackend(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(search_query: str) -> str:
+        return " ".join(search_query.lower().split())
+
+    async def next_url(self, key: str):
+        """Следующий кандидат по кругу, None для пустого результата или _MISS"""
+        raw = await self.state.get(f"unsplash:{key}")
+        if raw is None:
+            self.misses += 1
+            return _MISS
+        self.hits += 1
+        urls = orjson.loads(raw)
+        if not urls:
+            return None
+        cursor = await self.state.incr(f"unsplash:{key}:cursor", ttl=self.ttl)
+        return urls[cursor % len(urls)]
+
+    async def put(self, key: str, urls: List[str]):
+        ttl = self.ttl if urls else self.negative_ttl
+        await self.state.set(f"unsplash:{key}", orjson.dumps(urls), ttl=ttl)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(
+            self.state.stats(),
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=round(self.hits / lookups, 4) if lookups else 0.0
+        )
+
+
+class UnsplashProvider:
+    """Поиск изображений через Unsplash API поверх общего пула соединений"""
+
+    def __init__(self, api_key: Optional[str], http: "httpx.AsyncClient",
+                 base_url: str = "https://api.unsplash.com", timeout: Optional[float] = None,
+                 cache: Optional[SearchResultCache] = None, per_page: int = 1):
+        self.api_key = api_key
+        self.http = http
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = cache
+        self.per_page = per_page
+
+    async def search_image(self, query: str, style_prompt: str) -> Optional[str]:
+        """Ищет релевантное изображение в Unsplash"""
+        if not self.api_key:
+            return None
+
+        try:
+            # Комбинируем промпт стиля и запрос пользователя
+            search_query = f"{style_prompt} {query}"
+
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self.cache.key(search_query)
+                cached = await self.cache.next_url(cache_key)
+                if cached is not _MISS:
+                    return cached
+
+            headers = {
+                "Authorization": f"Client-ID {self.api_key}",
+                "Accept-Version": "v1"
+            }
+
+            params = {
+                "query": search_query[:100],  # Ограничиваем длину
+                "per_page": self.per_page,
+                "orientation": "squarish",
+                "content_filter": "high"
+            }
+
+            kwargs = {"timeout": self.timeout} if self.timeout is not None else {}
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                with span("unsplash"):
+                    response = await self.http.get(
+                        f"{self.base_url}/search/photos",
+                        headers=headers,
+                        params=params,
+                        **kwargs
+                    )
+                outcome = "success" if response.status_code == 200 else f"http_{response.status_code}"
+            finally:
+                UPSTREAM_LATENCY.labels("unsplash", outcome).observe(time.perf_counter() - started)
+
+            if response.status_code == 200:
+                data = response.json()
+                urls = [item["urls"]["regular"] for item in data.get("results") or []]
+                if cache_key is not None:
+                    await self.cache.put(cache_key, urls)
+                if urls:
+                    logger.info("Unsplash found %d images for: %s", len(urls), search_query,
+                                extra={"step": True})
+                    return urls[0]
+
+        except Exception as e:
+            logger.warning("Unsplash API error: %.100s", e)
+
+        return None